@@ -0,0 +1,185 @@
+"""Retouch a directory of photos without Discord, e.g. to reprocess an archive after a watermark change.
+
+Outputs use the same layout as the bot's local fallback:
+    approved_images_<supply>/watermarked/<name>.png
+    approved_images_<supply>/no_watermark/<name>.png
+
+A manifest in the output folder records every processed file, so an
+interrupted run can simply be restarted. Files are reprocessed when they
+change, or when the pipeline (version or stage settings) or watermark changes.
+
+Usage:
+    python batch_retouch.py archive/2023/ --supply 2023_archive
+    python batch_retouch.py "archive/**/*.jpg" --supply reshoot --workers 8
+"""
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp", ".bmp")
+MANIFEST_NAME = "manifest.jsonl"
+
+
+def iter_inputs(patterns):
+    """Yield image paths from directories (recursively) and globs, lazily and in a stable order"""
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for root, dirs, files in os.walk(pattern):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        else:
+            for path in sorted(glob.iglob(pattern, recursive=True)):
+                if os.path.isfile(path) and path.lower().endswith(IMAGE_EXTENSIONS):
+                    yield path
+
+
+def watermark_signature(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()[:16]
+
+
+def source_signature(path, pipeline_version, plan_signature, watermark):
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "pipeline": pipeline_version,
+        # Stage settings (PIPELINE_CONFIG, LINEAR_LIGHT) change the output without a version bump
+        "plan": plan_signature,
+        "watermark": watermark,
+    }
+
+
+def load_manifest(path):
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by an interrupted run
+            entries[entry["source"]] = entry
+    return entries
+
+
+def retouch_file(path, output_name, watermarked_dir, no_watermark_dir):
+    """Worker: retouch one photo and save both versions, returning timing details"""
+    import retoucher
+    from PIL import Image
+
+    start = time.perf_counter()
+    with Image.open(path) as source:
+        image = source.convert("RGB")
+    retouched = retoucher.retouch_image(image)
+    watermarked = retoucher.watermark_with(retoucher.DEFAULT_PLAN, retouched)
+    ok = retoucher.save_approved_image_locally(watermarked, retouched, output_name, watermarked_dir, no_watermark_dir)
+    if not ok:
+        raise RuntimeError(f"could not save {output_name}")
+    return {"pixels": image.width * image.height, "seconds": time.perf_counter() - start}
+
+
+def output_name_for(path, used_names):
+    """PNG name for a source file, made unique when different folders contain the same file name"""
+    stem = os.path.splitext(os.path.basename(path))[0]
+    name = f"{stem}.png"
+    suffix = 2
+    while name in used_names:
+        name = f"{stem}_{suffix}.png"
+        suffix += 1
+    used_names.add(name)
+    return name
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("inputs", nargs="+", help="input directories or glob patterns")
+    parser.add_argument("--supply", required=True, help="supply ID used for the output folder name")
+    parser.add_argument("--output-root", default="", help="where to create approved_images_<supply>")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2, help="worker processes")
+    parser.add_argument("--max-in-flight", type=int, default=None, help="images queued at once (default 2x workers)")
+    parser.add_argument("--force", action="store_true", help="reprocess files already in the manifest")
+    args = parser.parse_args()
+
+    import retoucher
+
+    local_dir, watermarked_dir, no_watermark_dir = retoucher.local_output_dirs(args.supply, args.output_root)
+    manifest_path = os.path.join(local_dir, MANIFEST_NAME)
+    manifest = {} if args.force else load_manifest(manifest_path)
+    watermark = watermark_signature(retoucher.WATERMARK_PATH)
+    used_names = {entry["output"] for entry in manifest.values()}
+    max_in_flight = args.max_in_flight or args.workers * 2
+
+    processed = skipped = failed = 0
+    total_pixels = 0
+    start = time.perf_counter()
+    pending = {}
+
+    def collect(done, manifest_file):
+        nonlocal processed, failed, total_pixels
+        for future in done:
+            source, output_name, signature = pending.pop(future)
+            try:
+                result = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"❌ {source}: {e}")
+                continue
+            processed += 1
+            total_pixels += result["pixels"]
+            manifest_file.write(json.dumps({"source": source, "output": output_name, **signature}) + "\n")
+            manifest_file.flush()
+            if processed % 25 == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{processed} processed, {skipped} skipped, {failed} failed ({processed / elapsed:.2f} images/s)")
+
+    # Spawned workers each import retoucher once; fork would copy the parent's threads and locks
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, mp_context=context) as pool, \
+            open(manifest_path, "a", encoding="utf-8") as manifest_file:
+        for path in iter_inputs(args.inputs):
+            source = os.path.abspath(path)
+            signature = source_signature(path, retoucher.PIPELINE_VERSION, retoucher.DEFAULT_PLAN.signature, watermark)
+            previous = manifest.get(source)
+            if previous is not None and all(previous.get(key) == value for key, value in signature.items()) \
+                    and os.path.exists(os.path.join(watermarked_dir, previous["output"])) \
+                    and os.path.exists(os.path.join(no_watermark_dir, previous["output"])):
+                skipped += 1
+                continue
+
+            output_name = previous["output"] if previous is not None else output_name_for(path, used_names)
+            future = pool.submit(retouch_file, path, output_name, watermarked_dir, no_watermark_dir)
+            pending[future] = (source, output_name, signature)
+
+            # Bound the work in flight so huge archives aren't queued all at once
+            if len(pending) >= max_in_flight:
+                done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done, manifest_file)
+
+        while pending:
+            done, _ = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            collect(done, manifest_file)
+
+    elapsed = time.perf_counter() - start
+    megapixels = total_pixels / 1_000_000
+    print(
+        f"\n✅ {processed} processed, {skipped} skipped, {failed} failed in {elapsed:.1f}s "
+        f"({processed / elapsed if elapsed > 0 else 0:.2f} images/s, "
+        f"{megapixels / elapsed if elapsed > 0 else 0:.1f} MP/s) -> {local_dir}"
+    )
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
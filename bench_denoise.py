@@ -0,0 +1,69 @@
+"""Compare the 'Retouch Again' denoisers on quality (PSNR vs. full NL-means) and latency.
+
+Usage:
+    python bench_denoise.py                      # synthetic images
+    python bench_denoise.py photo1.jpg photo2.jpg --budget 1.5
+"""
+import argparse
+import time
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import retoucher
+from benchmark import synthetic_image
+
+
+def load_image(path):
+    return cv2.cvtColor(np.array(Image.open(path).convert("RGB")), cv2.COLOR_RGB2BGR)
+
+
+def time_call(fn, repeat):
+    timings = []
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - start)
+    return result, min(timings)
+
+
+def benchmark(name, image, budget, repeat):
+    # Same pre-adjustment as retouch_image_aggressive
+    adjusted = cv2.convertScaleAbs(image, alpha=1.3, beta=15)
+    megapixels = image.shape[0] * image.shape[1] / 1_000_000
+    print(f"\n{name}: {image.shape[1]}x{image.shape[0]} ({megapixels:.1f} MP)")
+
+    reference, reference_time = time_call(lambda: retoucher.denoise(adjusted, "nlmeans"), 1)
+    print(f"  {'method':<16} {'latency':>9} {'MP/s':>8} {'PSNR':>8}")
+    print(f"  {'nlmeans':<16} {reference_time:>8.2f}s {megapixels / reference_time:>8.2f} {'ref':>8}")
+
+    for method in ("nlmeans_guided", "bilateral", "edge_preserving"):
+        # One untimed call calibrates the throughput estimate used for the budget
+        retoucher.denoise(adjusted, method, budget)
+        result, elapsed = time_call(lambda: retoucher.denoise(adjusted, method, budget), repeat)
+        psnr = cv2.PSNR(reference, result)
+        print(f"  {method:<16} {elapsed:>8.2f}s {megapixels / elapsed:>8.2f} {psnr:>7.2f}dB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("images", nargs="*", help="image files to benchmark (default: synthetic images)")
+    parser.add_argument("--sizes", default="2,6,12", help="synthetic image sizes in megapixels")
+    parser.add_argument("--budget", type=float, default=retoucher.DENOISE_TIME_BUDGET, help="time budget in seconds")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per method (best is reported)")
+    args = parser.parse_args()
+
+    if args.images:
+        for path in args.images:
+            benchmark(path, load_image(path), args.budget, args.repeat)
+    else:
+        for size in args.sizes.split(","):
+            megapixels = float(size)
+            image = cv2.cvtColor(synthetic_image(megapixels), cv2.COLOR_RGB2BGR)
+            benchmark(f"synthetic {megapixels:g}MP", image, args.budget, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,303 @@
+"""Reproducible benchmark of the retouch variants and pipeline stages.
+
+Every (variant or stage, image) case runs in a fresh process so peak RSS is
+measured per case. Allocations per image are reported as the pipeline buffers
+newly allocated (not reused from the pool) and the traced numpy allocation
+peak of one extra call; --no-pool gives the numbers before pooling. Results
+are saved as JSON and can be compared against an earlier run to catch
+regressions between commits.
+
+Usage:
+    python benchmark.py                                  # synthetic 1-100MP images
+    python benchmark.py --sizes 1,12 --fixtures photos/  # plus real photos
+    python benchmark.py --output new.json --compare old.json
+    python benchmark.py --targets retoucher --no-pool    # allocations without the buffer pool
+"""
+import argparse
+import ast
+import concurrent.futures
+import contextlib
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+from PIL import Image, ImageEnhance
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SIZES = "1,4,12,24,50,100"
+VARIANTS = ("retoucher", "retoucher_tiled", "opencv", "pil", "pipeline_default", "pipeline_opencv", "pipeline_pil",
+            "pipeline_robust", "pipeline_linear")
+STAGES = ("gray_world", "contrast", "sharpen", "sharpen_native", "stretch", "watermark", "png_encode")
+
+
+def synthetic_image(megapixels, seed=0, strip_rows=256):
+    """Product-shot-like RGB test image (gradients, flat shapes, sensor noise), built in strips"""
+    rng = np.random.default_rng(seed)
+    width = int((megapixels * 1_000_000 * 1.5) ** 0.5)
+    height = max(1, int(megapixels * 1_000_000 / width))
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    xs = np.linspace(30, 225, width).astype(np.int16)
+    for top in range(0, height, strip_rows):
+        bottom = min(top + strip_rows, height)
+        ys = np.linspace(40 + 150 * top / height, 40 + 150 * bottom / height, bottom - top).astype(np.int16)
+        strip = np.empty((bottom - top, width, 3), dtype=np.int16)
+        strip[..., 0] = xs[None, :]
+        strip[..., 1] = ys[:, None]
+        strip[..., 2] = 120
+        strip += rng.integers(-12, 13, strip.shape, dtype=np.int16)
+        np.clip(strip, 0, 255, out=strip)
+        image[top:bottom] = strip
+    cv2.circle(image, (width // 3, height // 2), height // 4, (220, 160, 40), -1)
+    cv2.rectangle(image, (width // 2, height // 4), (width * 5 // 6, height * 3 // 4), (235, 235, 235), -1)
+    return image
+
+
+def load_legacy_variant(filename):
+    """Compile only the first retouch_image definition of a legacy script.
+
+    openCV_version.py and PIL_version.py start their Discord client at import
+    time, so the function is extracted from the source instead of importing.
+    """
+    path = os.path.join(HERE, filename)
+    with open(path, "r", encoding="utf-8") as f:
+        tree = ast.parse(f.read(), path)
+    node = next(n for n in tree.body if isinstance(n, ast.FunctionDef) and n.name == "retouch_image")
+    namespace = {"cv2": cv2, "np": np, "Image": Image, "ImageEnhance": ImageEnhance}
+    exec(compile(ast.Module(body=[node], type_ignores=[]), path, "exec"), namespace)
+    return namespace["retouch_image"]
+
+
+def _peak_rss_bytes():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class SegmentProfiler:
+    """Pipeline timer collecting the duration of every executed plan segment"""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextlib.contextmanager
+    def __call__(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings.setdefault(name, []).append(time.perf_counter() - start)
+
+    def medians(self):
+        return {name: statistics.median(values) for name, values in self.timings.items()}
+
+
+def _prepare_case(target, image, profiler=None):
+    """Return a zero-argument callable running the target on its proper input"""
+    import pipeline
+    import retoucher
+
+    if target == "retoucher":
+        return lambda: retoucher.retouch_image(image)
+    if target == "retoucher_tiled":
+        return lambda: retoucher.retouch_image_tiled(image)
+    if target == "opencv":
+        fn = load_legacy_variant("openCV_version.py")
+        return lambda: fn(image)
+    if target == "pil":
+        fn = load_legacy_variant("PIL_version.py")
+        return lambda: fn(image)
+    if target.startswith("pipeline_"):
+        # The same configs run through the plan engine, timed segment by segment
+        plan = pipeline.compile_plan(pipeline.PRESETS[target[len("pipeline_"):]])
+        return lambda: plan.run(image, timer=profiler)
+
+    # Individual retoucher stages, each fed the output of the stages before it
+    balanced = retoucher.apply_gray_world(image)
+    if target == "gray_world":
+        return lambda: retoucher.apply_gray_world(image)
+    balanced_array = np.asarray(balanced)
+    alpha, beta = retoucher.contrast_params(np.mean(cv2.cvtColor(balanced_array, cv2.COLOR_RGB2GRAY)))
+    if target == "contrast":
+        return lambda: Image.fromarray(cv2.convertScaleAbs(balanced_array, alpha=alpha, beta=beta))
+    contrasted = Image.fromarray(cv2.convertScaleAbs(balanced_array, alpha=alpha, beta=beta))
+    if target == "sharpen":
+        return lambda: ImageEnhance.Sharpness(contrasted).enhance(1.3)
+    if target == "sharpen_native":
+        contrasted_array = np.asarray(contrasted)
+        return lambda: pipeline.sharpen(contrasted_array, 1.3)
+    sharpened = ImageEnhance.Sharpness(contrasted).enhance(1.3)
+    if target == "stretch":
+        return lambda: retoucher.component_stretching(sharpened)
+    retouched = retoucher.component_stretching(sharpened)
+    if target == "watermark":
+        return lambda: retoucher.add_watermark(retouched)
+    if target == "png_encode":
+        return lambda: retoucher.encode_png(retouched)
+    raise ValueError(f"Unknown benchmark target: {target}")
+
+
+def run_case(target, source, repeat, use_pool=True):
+    """Run one benchmark case (in a fresh worker process) and return its measurements"""
+    import pipeline
+
+    pipeline.buffer_pool.enabled = use_pool
+    if source.startswith("synthetic:"):
+        image = Image.fromarray(synthetic_image(float(source.split(":", 1)[1])))
+    else:
+        image = Image.open(source).convert("RGB")
+    profiler = SegmentProfiler()
+    fn = _prepare_case(target, image, profiler)
+
+    # Peak RSS is a high-water mark, so record it before the first timed call
+    baseline_rss = _peak_rss_bytes()
+    allocations_before = pipeline.buffer_pool.allocations
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    allocations = (pipeline.buffer_pool.allocations - allocations_before) / repeat
+    peak_rss = _peak_rss_bytes()
+
+    # Tracing slows allocation down, so the traced call is not among the timed ones
+    tracemalloc.start()
+    fn()
+    traced_peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    timings.sort()
+    megapixels = image.width * image.height / 1_000_000
+    p50 = statistics.median(timings)
+    p95 = timings[min(len(timings) - 1, int(round(0.95 * (len(timings) - 1))))]
+    return {
+        "target": target,
+        "kind": "variant" if target in VARIANTS else "stage",
+        "source": source,
+        "width": image.width,
+        "height": image.height,
+        "megapixels": round(megapixels, 3),
+        "repeat": repeat,
+        "p50_s": p50,
+        "p95_s": p95,
+        "mean_s": statistics.fmean(timings),
+        "mp_per_s": megapixels / p50 if p50 > 0 else None,
+        "peak_rss_mb": peak_rss / 1024 / 1024,
+        "peak_rss_delta_mb": max(peak_rss - baseline_rss, 0) / 1024 / 1024,
+        "buffer_pool": use_pool,
+        "allocations_per_image": allocations,
+        "traced_peak_mb": traced_peak / 1024 / 1024,
+        "segments": profiler.medians(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=HERE, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(results, baseline_path, threshold):
+    """Print p50 changes against a previous run; return the number of regressions"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    previous = {(r["target"], r["source"]): r for r in baseline["results"]}
+    regressions = 0
+    print(f"\nComparison with {baseline_path} (commit {baseline['meta'].get('commit')}):")
+    for result in results:
+        old = previous.get((result["target"], result["source"]))
+        if old is None:
+            continue
+        change = result["p50_s"] / old["p50_s"] - 1 if old["p50_s"] > 0 else 0.0
+        flag = ""
+        if change > threshold:
+            flag = "  <-- REGRESSION"
+            regressions += 1
+        print(f"  {result['target']:<16} {result['source']:<24} {old['p50_s']:>8.3f}s -> {result['p50_s']:>8.3f}s ({change:+.1%}){flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="synthetic image sizes in megapixels ('' for none)")
+    parser.add_argument("--fixtures", help="directory or glob of real images to include")
+    parser.add_argument("--targets", default=",".join(VARIANTS + STAGES), help="variants and stages to run")
+    parser.add_argument("--repeat", type=int, default=5, help="timed runs per case")
+    parser.add_argument("--output", default="benchmark_results.json", help="where to save the JSON results")
+    parser.add_argument("--compare", help="previous results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="p50 slowdown counted as a regression")
+    parser.add_argument("--no-pool", action="store_true", help="disable the pipeline buffer pool")
+    args = parser.parse_args()
+
+    sources = [f"synthetic:{size.strip()}" for size in args.sizes.split(",") if size.strip()]
+    if args.fixtures:
+        pattern = os.path.join(args.fixtures, "*") if os.path.isdir(args.fixtures) else args.fixtures
+        sources += sorted(p for p in glob.glob(pattern) if p.lower().endswith((".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp")))
+    targets = [t.strip() for t in args.targets.split(",") if t.strip()]
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    print(
+        f"{'target':<16} {'source':<24} {'MP':>6} {'p50':>9} {'p95':>9} {'MP/s':>8} {'peak RSS':>10} "
+        f"{'RSS/img':>9} {'allocs':>7} {'traced':>9}"
+    )
+    for source in sources:
+        for target in targets:
+            # A fresh process per case keeps peak RSS measurements independent
+            with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                try:
+                    result = pool.submit(run_case, target, source, args.repeat, not args.no_pool).result()
+                except Exception as e:
+                    print(f"{target:<16} {source:<24} failed: {e}")
+                    continue
+            results.append(result)
+            print(
+                f"{target:<16} {source:<24} {result['megapixels']:>6.1f} {result['p50_s']:>8.3f}s "
+                f"{result['p95_s']:>8.3f}s {result['mp_per_s'] or 0:>8.2f} {result['peak_rss_mb']:>8.0f}MB "
+                f"{result['peak_rss_delta_mb']:>7.0f}MB {result['allocations_per_image']:>7.1f} "
+                f"{result['traced_peak_mb']:>7.0f}MB"
+            )
+            for name, seconds in result["segments"].items():
+                print(f"  {name:<38} {seconds:>8.3f}s")
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "numpy": np.__version__,
+            "opencv": cv2.__version__,
+            "pillow": Image.__version__,
+            "repeat": args.repeat,
+            "buffer_pool": not args.no_pool,
+        },
+        "results": results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nSaved {len(results)} results to {args.output}")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.threshold)
+        if regressions:
+            print(f"{regressions} regression(s) above {args.threshold:.0%}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
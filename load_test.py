@@ -0,0 +1,536 @@
+"""End-to-end load test of the QC bot against a fake Discord and a stand-in Drive server.
+
+Simulated photographers post supplies with image attachments while simulated
+reviewers click through the QC buttons, fail some images (feedback modal and
+"Retouch Again") and finalize. The real handlers in retoucher.py run unchanged;
+only the Discord objects are faked, and the Drive client is pointed at a local
+HTTP server that implements the Drive v3 calls the bot makes.
+
+Usage:
+    python load_test.py                                  # 20 sessions of 4x 2MP images
+    python load_test.py --sessions 50 --images 8 --megapixels 12 --fail-rate 0.2
+    python load_test.py --no-drive --output load_results.json
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import random
+import re
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+_ids = itertools.count(10_000)
+
+# How long a session may take to finalize after the reviewer's last click
+FINALIZE_TIMEOUT = 120
+
+
+def next_id():
+    return next(_ids)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return (peak if sys.platform == "darwin" else peak * 1024) / 1024 / 1024
+
+
+# --- Stand-in Drive v3 server ---
+class FakeDriveServer:
+    """Threaded HTTP server answering files.create (metadata and multipart upload) and permissions.create"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.files = {}
+        self.requests = 0
+        self.uploaded_bytes = 0
+        server = self
+
+        class DriveHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if server.latency:
+                    time.sleep(server.latency)
+                path = urllib.parse.urlparse(self.path).path
+                if path.endswith("/permissions"):
+                    self._reply({"kind": "drive#permission", "id": "anyoneWithLink", "type": "anyone", "role": "reader"})
+                elif path.endswith("/drive/v3/files"):
+                    self._reply(server.create_file(body, upload=path.startswith("/upload/")))
+                else:
+                    self.send_error(404)
+                with server.lock:
+                    server.requests += 1
+
+            def _reply(self, payload):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json; charset=UTF-8")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), DriveHandler)
+        self.base_url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="fake-drive", daemon=True)
+
+    def create_file(self, body, upload):
+        if upload:
+            # multipart/related: the JSON metadata part comes before the media part
+            match = re.search(rb"\{[^{}]*\}", body)
+            metadata = json.loads(match.group(0)) if match else {}
+        else:
+            metadata = json.loads(body or b"{}")
+        file_id = f"fake{next_id()}"
+        with self.lock:
+            self.files[file_id] = metadata
+            if upload:
+                self.uploaded_bytes += len(body)
+        return {"id": file_id, "webViewLink": f"{self.base_url}/view/{file_id}"}
+
+    def transport(self):
+        """httplib2-compatible transport that sends googleapis.com requests to this server"""
+        import httplib2
+
+        base_url = self.base_url
+
+        class StandInHttp:
+            def __init__(self):
+                self.http = httplib2.Http()
+
+            def request(self, uri, method="GET", body=None, headers=None, redirections=5, connection_type=None):
+                parsed = urllib.parse.urlparse(uri)
+                target = base_url + parsed.path + (f"?{parsed.query}" if parsed.query else "")
+                return self.http.request(target, method=method, body=body, headers=headers, redirections=redirections)
+
+        return StandInHttp()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# --- Fake Discord objects ---
+class FakeUser:
+    def __init__(self, user_id, name):
+        self.id = user_id
+        self.name = name
+        self.display_name = name
+        self.mention = f"<@{user_id}>"
+        # Marked as a bot so bot.process_commands() ignores the fake messages
+        self.bot = True
+
+
+class FakeAttachment:
+    def __init__(self, filename, data, content_type="image/jpeg"):
+        self.id = next_id()
+        self.filename = filename
+        self.content_type = content_type
+        self.size = len(data)
+        self.data = data
+
+    async def read(self):
+        await asyncio.sleep(0)
+        return self.data
+
+
+def consume_file(file):
+    """Read a discord.File like an upload would, returning its size"""
+    if file is None:
+        return 0
+    data = file.fp.read()
+    file.close()
+    return len(data)
+
+
+class FakeMessage:
+    def __init__(self, channel, author, content="", attachments=(), embed=None, view=None):
+        self.id = next_id()
+        self.channel = channel
+        self.author = author
+        self.content = content
+        self.attachments = list(attachments)
+        self.embed = embed
+        self.view = view
+        self.deleted = False
+        self.guild = None
+
+    async def reply(self, content=None, *, embed=None, file=None, view=None, **kwargs):
+        return await self.channel.send(content, embed=embed, file=file, view=view)
+
+    async def edit(self, *, content=None, embed=None, attachments=None, view=None, **kwargs):
+        await self.channel.api_call()
+        if content is not None:
+            self.content = content
+        if embed is not None:
+            self.embed = embed
+        for file in attachments or ():
+            self.channel.uploaded_bytes += consume_file(file)
+        if view is not None:
+            self.view = view
+            self.channel.track_view(self)
+        return self
+
+    async def delete(self):
+        await self.channel.api_call()
+        self.deleted = True
+
+
+class FakeChannel:
+    """One channel per simulated session, all sharing the configured channel ID"""
+
+    def __init__(self, channel_id, bot_user, latency):
+        self.id = channel_id
+        self.bot_user = bot_user
+        self.latency = latency
+        self.messages = []
+        self.uploaded_bytes = 0
+        self.qc_message = None
+
+    async def api_call(self):
+        await asyncio.sleep(self.latency)
+
+    def track_view(self, message):
+        # The message carrying the newest QC buttons is where the reviewer clicks next
+        if type(message.view).__name__ == "QCButtons":
+            self.qc_message = message
+
+    async def send(self, content=None, *, embed=None, file=None, view=None, **kwargs):
+        await self.api_call()
+        message = FakeMessage(self, self.bot_user, content or "", embed=embed, view=view)
+        self.uploaded_bytes += consume_file(file)
+        self.messages.append(message)
+        self.track_view(message)
+        return message
+
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self.done = False
+        self.modal = None
+        self.message = None
+
+    def is_done(self):
+        return self.done
+
+    def _respond(self):
+        import discord
+
+        if self.done:
+            raise discord.errors.InteractionResponded(self.interaction)
+        self.done = True
+
+    async def defer(self, **kwargs):
+        self._respond()
+        await self.interaction.channel.api_call()
+
+    async def send_message(self, content=None, *, embed=None, view=None, ephemeral=False, **kwargs):
+        self._respond()
+        self.message = await self.interaction.channel.send(content, embed=embed, view=view)
+
+    async def edit_message(self, **kwargs):
+        self._respond()
+        await self.interaction.message.edit(**kwargs)
+
+    async def send_modal(self, modal):
+        self._respond()
+        await self.interaction.channel.api_call()
+        self.modal = modal
+
+
+class FakeInteraction:
+    def __init__(self, user, message):
+        self.id = next_id()
+        self.user = user
+        self.message = message
+        self.channel = message.channel
+        self.guild = None
+        self.response = FakeResponse(self)
+
+
+# --- Load generation ---
+def make_attachments(count, megapixels, seed):
+    """Distinct JPEG attachments so the retouch cache and duplicate detection don't short-circuit work"""
+    from PIL import Image
+
+    from benchmark import synthetic_image
+
+    attachments = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        Image.fromarray(synthetic_image(megapixels, seed=seed * 1000 + i)).save(buffer, format="JPEG", quality=90)
+        attachments.append(FakeAttachment(f"IMG_{seed:04d}_{i + 1}.jpg", buffer.getvalue()))
+    return attachments
+
+
+async def click(view, button_name, user, message):
+    """Run a button callback the way discord.py does: interaction_check, then the callback"""
+    interaction = FakeInteraction(user, message)
+    if await view.interaction_check(interaction):
+        await getattr(view, button_name).callback(interaction)
+    return interaction
+
+
+async def run_session(retoucher, number, args, bot_user, stats):
+    rng = random.Random(args.seed + number)
+    photographer = FakeUser(1_000 + number, f"photographer{number}")
+    reviewer = FakeUser(2_000 + number, f"reviewer{number}")
+    channel = FakeChannel(retoucher.CHANNEL_ID, bot_user, args.discord_latency)
+    attachments = await asyncio.to_thread(make_attachments, args.images, args.megapixels, args.seed + number)
+    message = FakeMessage(channel, photographer, f"Supply ID: LOAD{number:04d}", attachments)
+
+    start = time.perf_counter()
+    await retoucher.on_message(message)
+    if channel.qc_message is None:
+        stats["failed_sessions"] += 1
+        print(f"Session {number}: no QC message was posted")
+        return
+    first_image = time.perf_counter() - start
+    session = retoucher.active_sessions[channel.qc_message.id]
+    bulk_pass = rng.random() < args.bulk_pass_rate
+    if rng.random() < args.contact_sheet_rate:
+        # Triage from the grid of the whole supply instead of one image per message
+        await click(channel.qc_message.view, "contact_sheet_button", reviewer, channel.qc_message)
+        stats["clicks"] += 1
+
+    for index in range(args.images):
+        # Auto-QC may have passed the remaining images already
+        if session.is_complete():
+            break
+        await asyncio.sleep(args.think_time * rng.uniform(0.5, 1.5))
+        qc_message = channel.qc_message
+        if bulk_pass and index > 0:
+            # Everything after the first image looks fine: pass the rest with one click
+            await click(qc_message.view, "pass_all_button", reviewer, qc_message)
+            stats["clicks"] += 1
+            break
+        if rng.random() < args.fail_rate:
+            interaction = await click(qc_message.view, "not_pass_button", reviewer, qc_message)
+            modal = interaction.response.modal
+            modal.feedback._value = "Too dark, please brighten"
+            submit = FakeInteraction(reviewer, qc_message)
+            if await modal.interaction_check(submit):
+                await modal.on_submit(submit)
+            stats["failed_images"] += 1
+
+            if rng.random() < args.retry_rate:
+                # "Retouch Again" lives on the feedback message and brings the image back for review
+                await asyncio.sleep(args.think_time)
+                retry_start = time.perf_counter()
+                feedback_message = submit.response.message
+                await click(feedback_message.view, "retouch_button", reviewer, feedback_message)
+                stats["retouch_again_latency"].append(time.perf_counter() - retry_start)
+                qc_message = channel.qc_message
+                await click(qc_message.view, "pass_button", reviewer, qc_message)
+        else:
+            await click(qc_message.view, "pass_button", reviewer, qc_message)
+        stats["clicks"] += 1
+
+    # The last click (or auto-QC, when it decided the last pending images) finalizes the session
+    try:
+        await asyncio.wait_for(session.finalized.wait(), FINALIZE_TIMEOUT)
+    except asyncio.TimeoutError:
+        stats["failed_sessions"] += 1
+        print(f"Session {number}: QC was never finalized")
+        return
+    await session.wait_until_ingested()
+    stats["session_memory_mb"].append(session.memory_bytes() / 1024 / 1024)
+    stats["first_image_latency"].append(first_image)
+    stats["session_latency"].append(time.perf_counter() - start)
+    stats["discord_uploaded_bytes"] += channel.uploaded_bytes
+    stats["completed_sessions"] += 1
+
+
+async def monitor_loop_lag(interval, samples, stop):
+    """Measure how late the event loop wakes up a sleeping coroutine"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+async def run_load(retoucher, args):
+    bot_user = FakeUser(1, "retoucher")
+    bot_user.bot = False
+    stats = {
+        "completed_sessions": 0,
+        "failed_sessions": 0,
+        "clicks": 0,
+        "failed_images": 0,
+        "discord_uploaded_bytes": 0,
+        "first_image_latency": [],
+        "session_latency": [],
+        "retouch_again_latency": [],
+        "session_memory_mb": [],
+    }
+    lag_samples = []
+    stop = asyncio.Event()
+    lag_task = asyncio.create_task(monitor_loop_lag(args.lag_interval, lag_samples, stop))
+    # Set LOOP_WATCHDOG_MS to also log the call sites behind any stalls
+    retoucher.start_loop_watchdog()
+
+    start = time.perf_counter()
+    sessions = []
+    for number in range(args.sessions):
+        sessions.append(asyncio.create_task(run_session(retoucher, number, args, bot_user, stats)))
+        await asyncio.sleep(args.arrival_interval)
+    results = await asyncio.gather(*sessions, return_exceptions=True)
+    elapsed = time.perf_counter() - start
+
+    stop.set()
+    await lag_task
+    for number, result in enumerate(results):
+        if isinstance(result, Exception):
+            stats["failed_sessions"] += 1
+            print(f"Session {number} raised {type(result).__name__}: {result}")
+    return stats, lag_samples, elapsed
+
+
+def summarize(values, scale=1.0):
+    return {
+        "p50": percentile(values, 0.50) * scale,
+        "p95": percentile(values, 0.95) * scale,
+        "p99": percentile(values, 0.99) * scale,
+        "max": max(values, default=0.0) * scale,
+        "mean": (statistics.fmean(values) if values else 0.0) * scale,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=20, help="number of simulated QC sessions")
+    parser.add_argument("--images", type=int, default=4, help="images per session")
+    parser.add_argument("--megapixels", type=float, default=2.0, help="size of each synthetic image")
+    parser.add_argument("--arrival-interval", type=float, default=0.5, help="seconds between new sessions")
+    parser.add_argument("--think-time", type=float, default=0.5, help="average reviewer delay between clicks")
+    parser.add_argument("--fail-rate", type=float, default=0.15, help="share of images the reviewer fails")
+    parser.add_argument("--retry-rate", type=float, default=0.8, help="share of failed images retouched again")
+    parser.add_argument("--bulk-pass-rate", type=float, default=0.0,
+                        help="share of reviewers who pass all remaining images after the first")
+    parser.add_argument("--contact-sheet-rate", type=float, default=0.0,
+                        help="share of reviewers who switch to the contact sheet before reviewing")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="simulated Discord API latency")
+    parser.add_argument("--drive-latency", type=float, default=0.05, help="simulated Drive API latency")
+    parser.add_argument("--no-drive", action="store_true", help="save approved images locally instead of to Drive")
+    parser.add_argument("--lag-interval", type=float, default=0.05, help="event-loop lag sampling interval")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep-workdir", action="store_true", help="keep traces and local saves for inspection")
+    parser.add_argument("--output", help="save the report as JSON")
+    args = parser.parse_args()
+
+    # Keep caches, indexes, traces and local saves out of the working tree
+    invocation_dir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="retoucher_load_")
+    os.environ.setdefault("CHANNEL_ID", "0")
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("RETOUCH_CACHE_DIR", os.path.join(workdir, "cache"))
+    os.environ.setdefault("PHASH_INDEX_PATH", os.path.join(workdir, "phash_index.json"))
+    os.environ.setdefault("TRACE_LOG_PATH", os.path.join(workdir, "session_traces.jsonl"))
+    os.environ["WATERMARK_PATH"] = os.path.abspath(os.getenv("WATERMARK_PATH", os.path.join(HERE, "Water_Mark.png")))
+    sys.path.insert(0, HERE)
+    os.chdir(workdir)
+
+    tracemalloc.start()
+    import retoucher
+
+    drive = None
+    if not args.no_drive:
+        drive = FakeDriveServer(args.drive_latency).start()
+        retoucher.drive_http_factory = drive.transport
+
+    print(
+        f"Running {args.sessions} sessions x {args.images} images ({args.megapixels:g}MP), "
+        f"{retoucher.SCHEDULER_WORKERS} workers, Drive {'stand-in' if drive else 'disabled'}, workdir {workdir}"
+    )
+    try:
+        stats, lag_samples, elapsed = asyncio.run(run_load(retoucher, args))
+    finally:
+        if drive is not None:
+            drive.stop()
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    report = {
+        "config": vars(args),
+        "elapsed_s": elapsed,
+        "completed_sessions": stats["completed_sessions"],
+        "failed_sessions": stats["failed_sessions"],
+        "images_per_s": stats["completed_sessions"] * args.images / elapsed if elapsed > 0 else 0.0,
+        "clicks": stats["clicks"],
+        "failed_images": stats["failed_images"],
+        "loop_lag_ms": summarize(lag_samples, 1000),
+        "first_image_latency_s": summarize(stats["first_image_latency"]),
+        "session_latency_s": summarize(stats["session_latency"]),
+        "retouch_again_latency_s": summarize(stats["retouch_again_latency"]),
+        "session_memory_mb": summarize(stats["session_memory_mb"]),
+        "peak_rss_mb": peak_rss_mb(),
+        "peak_python_heap_mb": traced_peak / 1024 / 1024,
+        "discord_uploaded_mb": stats["discord_uploaded_bytes"] / 1024 / 1024,
+        "drive_requests": drive.requests if drive else 0,
+        "drive_uploaded_mb": drive.uploaded_bytes / 1024 / 1024 if drive else 0.0,
+        "scheduler": retoucher.scheduler.metrics(),
+    }
+
+    print(f"\nCompleted {report['completed_sessions']}/{args.sessions} sessions in {elapsed:.1f}s "
+          f"({report['images_per_s']:.2f} images/s), {report['failed_sessions']} failed")
+    print(f"{'':<24} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}")
+    for label, key, unit in (
+        ("event-loop lag", "loop_lag_ms", "ms"),
+        ("first image", "first_image_latency_s", "s"),
+        ("session end-to-end", "session_latency_s", "s"),
+        ("retouch again", "retouch_again_latency_s", "s"),
+        ("session memory", "session_memory_mb", "MB"),
+    ):
+        row = report[key]
+        print(f"{label:<24} " + " ".join(f"{row[q]:>7.2f}{unit:<2}" for q in ("p50", "p95", "p99", "max")))
+    print(f"peak RSS {report['peak_rss_mb']:.0f}MB, peak Python heap {report['peak_python_heap_mb']:.0f}MB")
+    print(f"Discord uploads {report['discord_uploaded_mb']:.1f}MB, "
+          f"Drive {report['drive_requests']} requests / {report['drive_uploaded_mb']:.1f}MB")
+
+    if args.output:
+        output = os.path.join(invocation_dir, args.output)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+        print(f"Saved report to {output}")
+
+    if args.keep_workdir:
+        print(f"Traces and local saves kept in {workdir}")
+    else:
+        os.chdir(invocation_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if report["failed_sessions"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
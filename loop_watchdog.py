@@ -0,0 +1,97 @@
+"""Event-loop watchdog: measures loop lag and logs the stack of code that blocks the loop"""
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+
+class LoopWatchdog:
+    """A heartbeat coroutine on the loop plus a watchdog thread that notices missed beats.
+
+    When a callback keeps the loop busy for longer than `threshold` seconds, the
+    watchdog thread captures the loop thread's current stack (the blocking code
+    is still running at that point) and logs it, together with whatever
+    `context(frame)` returns for the innermost frame.
+    """
+
+    def __init__(self, threshold, interval=None, on_lag=None, on_stall=None, context=None, stack_limit=25):
+        self.threshold = threshold
+        self.interval = interval or min(threshold / 2, 0.1)
+        self.on_lag = on_lag
+        self.on_stall = on_stall
+        self.context = context
+        self.stack_limit = stack_limit
+        self.lock = threading.Lock()
+        self.beat = 0
+        self.last_beat = time.monotonic()
+        self.reported_beat = -1
+        self.loop_thread_id = None
+        self.task = None
+        self.thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Start watching the running loop (call from a coroutine on that loop)"""
+        self.loop_thread_id = threading.get_ident()
+        self.task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self.thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _heartbeat(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            with self.lock:
+                self.beat += 1
+                self.last_beat = time.monotonic()
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            if self.on_lag is not None:
+                self.on_lag(lag)
+            if lag >= self.threshold:
+                print(f"⚠️ Event loop was blocked for {lag * 1000:.0f}ms")
+
+    def _watch(self):
+        while not self._stop.wait(self.interval / 2):
+            with self.lock:
+                beat, last_beat = self.beat, self.last_beat
+            # The next beat is due one interval after the last one started sleeping
+            blocked = time.monotonic() - last_beat - self.interval
+            if blocked >= self.threshold and beat != self.reported_beat:
+                self.reported_beat = beat
+                self._report(blocked)
+
+    def _report(self, blocked):
+        frame = sys._current_frames().get(self.loop_thread_id)
+        if frame is None:
+            return
+        context = None
+        if self.context is not None:
+            try:
+                context = self.context(frame)
+            except Exception as e:
+                context = f"context unavailable: {e}"
+        stack = "".join(traceback.format_stack(frame, limit=self.stack_limit))
+        print(
+            f"⚠️ Event loop blocked for more than {blocked * 1000:.0f}ms"
+            f"{f' ({context})' if context else ''}; blocking call site:\n{stack}"
+        )
+        if self.on_stall is not None:
+            self.on_stall(blocked, context)
+
+
+def find_in_frames(frame, predicate):
+    """Walk from the innermost frame outwards and return the first non-None predicate(frame) result"""
+    while frame is not None:
+        result = predicate(frame)
+        if result is not None:
+            return result
+        frame = frame.f_back
+    return None
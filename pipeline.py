@@ -0,0 +1,907 @@
+"""Declarative retouch pipeline compiled into a fused execution plan.
+
+A pipeline is declared as a list of stage specs, for example
+
+    [{"stage": "gray_world"}, {"stage": "gain"}, {"stage": "sharpen", "factor": 1.3}, {"stage": "stretch"}]
+
+compile_plan() groups adjacent pointwise stages (gray world, gain, stretch, ...)
+into one segment whose per-channel 256-entry lookup tables are composed and
+applied in a single cv2.LUT pass. The statistics those stages need are read
+from channel histograms propagated through the tables built so far, so a fused
+segment costs one histogram pass plus one LUT pass. Spatial stages (sharpen,
+blur, denoise) and image stages (watermark) run on their own. Images stay RGB
+uint8 arrays throughout; PIL is only involved at the ends and in stages that
+need it. Full-frame intermediates are taken from a per-thread BufferPool and
+written with dst= arguments, so a long-running worker reuses the same few
+buffers instead of allocating new ones for every image.
+"""
+import collections
+import contextlib
+import hashlib
+import json
+import threading
+
+import cv2
+import numpy as np
+from PIL import Image
+
+LEVELS = np.arange(256, dtype=np.uint8)
+CHANNELS = "rgb"
+
+# Linear-light color correction decodes through a 256-entry sRGB -> linear table and
+# re-encodes through a 4096-entry linear -> sRGB one (fine enough to round-trip every level)
+LINEAR_LEVELS = 4096
+
+
+def _srgb_tables():
+    encoded = LEVELS / 255
+    to_linear = np.where(encoded <= 0.04045, encoded / 12.92, ((encoded + 0.055) / 1.055) ** 2.4)
+    linear = np.arange(LINEAR_LEVELS) / (LINEAR_LEVELS - 1)
+    to_srgb = np.where(linear <= 0.0031308, linear * 12.92, 1.055 * linear ** (1 / 2.4) - 0.055)
+    return to_linear, np.clip(np.rint(to_srgb * 255), 0, 255).astype(np.uint8)
+
+
+SRGB_TO_LINEAR, LINEAR_TO_SRGB = _srgb_tables()
+
+# cv2.calcHist counts in float32, so histograms are gathered in strips well below 2**24 pixels
+HIST_STRIP_PIXELS = 4_000_000
+
+# Upper bound on the pixels stacked into one (N, H, W, 3) batch by Plan.run_batch
+BATCH_MAX_PIXELS = 100_000_000
+
+# Scratch memory a worker thread keeps for reuse between images
+BUFFER_POOL_MAX_BYTES = 256 * 1024 * 1024
+
+STAGES = {}
+
+
+class BufferPool:
+    """Reusable scratch arrays keyed by (shape, dtype), with one free list per thread.
+
+    acquire() hands out a pooled array (or a new one when none is free) and
+    release() returns it once nothing references it any more. Each thread only
+    sees its own buffers, so scheduler workers never share an intermediate.
+    """
+
+    def __init__(self, max_bytes=BUFFER_POOL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.enabled = True
+        self.allocations = 0
+        self.reuses = 0
+        # Optional callback(result) per acquire(), with result "allocated" or "reused" (e.g. a metrics counter)
+        self.on_acquire = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _free_lists(self):
+        local = self._local
+        if not hasattr(local, "buffers"):
+            local.buffers = {}
+            local.nbytes = 0
+        return local
+
+    def acquire(self, shape, dtype=np.uint8):
+        key = (tuple(shape), np.dtype(dtype).str)
+        if self.enabled:
+            local = self._free_lists()
+            free = local.buffers.get(key)
+            if free:
+                buffer = free.pop()
+                local.nbytes -= buffer.nbytes
+                with self._lock:
+                    self.reuses += 1
+                if self.on_acquire is not None:
+                    self.on_acquire("reused")
+                return buffer
+        with self._lock:
+            self.allocations += 1
+        if self.on_acquire is not None:
+            self.on_acquire("allocated")
+        return np.empty(shape, dtype=dtype)
+
+    def release(self, buffer):
+        """Return a buffer to this thread's free list; views and read-only arrays are ignored"""
+        if not self.enabled or buffer is None or buffer.base is not None or not buffer.flags.writeable:
+            return
+        local = self._free_lists()
+        if local.nbytes + buffer.nbytes > self.max_bytes:
+            return
+        local.buffers.setdefault((buffer.shape, buffer.dtype.str), []).append(buffer)
+        local.nbytes += buffer.nbytes
+
+    def clear(self):
+        """Drop this thread's free buffers"""
+        local = self._free_lists()
+        local.buffers.clear()
+        local.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {"allocations": self.allocations, "reuses": self.reuses}
+
+
+buffer_pool = BufferPool()
+
+
+class StageCache:
+    """Memo of plan intermediates and statistics, keyed by the stage prefix that produced them.
+
+    Statistics (histograms, gray means) are small and kept until their owner
+    is cleared; intermediate images are read-only arrays evicted least
+    recently used first once all owners together exceed max_bytes. Use
+    scope() to get the view for one image of one owner (e.g. a QC session).
+    Safe to share between worker threads.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._arrays = collections.OrderedDict()
+        self._stats = {}
+        self._owner_bytes = collections.Counter()
+        self._lock = threading.Lock()
+
+    def scope(self, name, owner=None, arrays=True):
+        """View for one image; with arrays=False only statistics are read and stored"""
+        return StageCacheScope(self, name, owner, arrays)
+
+    def get_array(self, key):
+        with self._lock:
+            array = self._arrays.get(key)
+            if array is None:
+                self.misses += 1
+                return None
+            self._arrays.move_to_end(key)
+            self.hits += 1
+            return array
+
+    def put_array(self, key, array):
+        """Store a read-only array under (owner, name, key) (a copy is made when array is a view)"""
+        if self.max_bytes <= 0 or array.nbytes > self.max_bytes:
+            return
+        if array.base is not None:
+            array = array.copy()
+        array.flags.writeable = False
+        with self._lock:
+            self._drop(key)
+            self._arrays[key] = array
+            self.nbytes += array.nbytes
+            self._owner_bytes[key[0]] += array.nbytes
+            while self.nbytes > self.max_bytes:
+                self._drop(next(iter(self._arrays)))
+
+    def _drop(self, key):
+        array = self._arrays.pop(key, None)
+        if array is not None:
+            self.nbytes -= array.nbytes
+            self._owner_bytes[key[0]] -= array.nbytes
+
+    def get_stat(self, key):
+        with self._lock:
+            return self._stats.get(key)
+
+    def put_stat(self, key, value):
+        with self._lock:
+            self._stats[key] = value
+
+    def owner_nbytes(self, owner):
+        """Bytes of intermediate images currently held for one owner"""
+        with self._lock:
+            return self._owner_bytes.get(owner, 0)
+
+    def clear(self, owner=None):
+        """Drop everything, or only the entries of one owner"""
+        with self._lock:
+            if owner is None:
+                self._arrays.clear()
+                self._stats.clear()
+                self._owner_bytes.clear()
+                self.nbytes = 0
+                return
+            for key in [key for key in self._arrays if key[0] == owner]:
+                self._drop(key)
+            for key in [key for key in self._stats if key[0] == owner]:
+                del self._stats[key]
+            self._owner_bytes.pop(owner, None)
+
+
+class StageCacheScope:
+    """The part of a StageCache belonging to one image of one owner"""
+
+    def __init__(self, cache, name, owner=None, arrays=True):
+        self.cache = cache
+        self.name = name
+        self.owner = owner
+        self.arrays = arrays
+
+    def get_array(self, key):
+        if not self.arrays:
+            return None
+        return self.cache.get_array((self.owner, self.name, key))
+
+    def put_array(self, key, array):
+        if self.arrays:
+            self.cache.put_array((self.owner, self.name, key), array)
+
+    def get_stat(self, key):
+        return self.cache.get_stat((self.owner, self.name, key))
+
+    def put_stat(self, key, value):
+        self.cache.put_stat((self.owner, self.name, key), value)
+
+
+class StageType:
+    def __init__(self, name, kind, fn, halo=0, writes_dst=False):
+        self.name = name
+        self.kind = kind
+        self.fn = fn
+        self.halo = halo
+        self.writes_dst = writes_dst
+
+
+def register_stage(name, kind, halo=0, writes_dst=False):
+    """Register a pipeline stage under a name usable in configs.
+
+    kind is one of:
+      "pointwise": fn(stats, **params) returns a (3, 256) uint8 table per RGB channel
+      "spatial":   fn(rgb, **params) returns a new RGB uint8 array; halo is the number
+                   of neighbouring rows an output row depends on (a callable of the
+                   params, or None when the stage cannot run in strips). With
+                   writes_dst the stage is called as fn(rgb, dst=buffer, **params)
+                   and writes its result into the pooled buffer.
+      "image":     fn(pil_image, **params) returns a PIL image; only allowed at the end
+    """
+    if kind not in ("pointwise", "spatial", "image"):
+        raise ValueError(f"Unknown stage kind: {kind}")
+
+    def decorator(fn):
+        STAGES[name] = StageType(name, kind, fn, halo, writes_dst)
+        return fn
+    return decorator
+
+
+# --- Lookup tables and statistics ---
+def identity_lut():
+    return np.tile(LEVELS, (3, 1))
+
+
+def scale_lut(alpha, beta=0.0):
+    """Table of cv2.convertScaleAbs(v, alpha, beta); alpha and beta may be given per channel"""
+    alphas = np.broadcast_to(np.asarray(alpha, dtype=np.float64), (3,))
+    betas = np.broadcast_to(np.asarray(beta, dtype=np.float64), (3,))
+    return np.stack([
+        cv2.convertScaleAbs(LEVELS, alpha=float(a), beta=float(b)).ravel() for a, b in zip(alphas, betas)
+    ])
+
+
+def compose_luts(first, second):
+    """Table applying first, then second"""
+    return np.take_along_axis(second, first.astype(np.intp), axis=1)
+
+
+def propagate_histograms(hist, lut):
+    """Channel histograms of an image after mapping it through lut"""
+    return np.stack([
+        np.bincount(lut[c], weights=hist[c], minlength=256).astype(np.int64) for c in range(3)
+    ])
+
+
+def cv_lut(lut):
+    """(3, 256) table in the (256, 1, 3) layout cv2.LUT expects for 3-channel images"""
+    return np.ascontiguousarray(lut.T).reshape(256, 1, 3)
+
+
+def array_strips(rgb, max_pixels=HIST_STRIP_PIXELS):
+    rows = max(1, max_pixels // max(rgb.shape[1], 1))
+    for top in range(0, rgb.shape[0], rows):
+        yield rgb[top:top + rows]
+
+
+def strip_histograms(strip):
+    return np.stack([
+        cv2.calcHist([strip], [c], None, [256], [0, 256]).ravel().astype(np.int64) for c in range(3)
+    ])
+
+
+def channel_histograms(strips):
+    hist = np.zeros((3, 256), dtype=np.int64)
+    for strip in strips:
+        hist += strip_histograms(strip)
+    return hist
+
+
+def batch_histograms(batch, max_pixels=HIST_STRIP_PIXELS):
+    """Channel histograms of every image of an (N, H, W, 3) batch, shape (N, 3, 256).
+
+    Each chunk of rows is counted for all images and channels with a single
+    np.bincount over keys offset by image and channel.
+    """
+    count, height, width = batch.shape[:3]
+    offsets = (np.arange(count, dtype=np.int32)[:, None, None, None] * 768
+               + np.arange(3, dtype=np.int32)[None, None, None, :] * 256)
+    rows = max(1, max_pixels // max(count * width, 1))
+    hist = np.zeros(count * 768, dtype=np.int64)
+    for top in range(0, height, rows):
+        keys = batch[:, top:top + rows].astype(np.int32)
+        keys += offsets
+        hist += np.bincount(keys.ravel(), minlength=count * 768)
+    return hist.reshape(count, 3, 256)
+
+
+def batch_buckets(sizes, max_pixels, max_images=None):
+    """Group image indices by (width, height) into batches of at most max_pixels (and max_images)"""
+    buckets = {}
+    for index, size in enumerate(sizes):
+        buckets.setdefault(tuple(size), []).append(index)
+    batches = []
+    for (width, height), indices in buckets.items():
+        per_batch = max(1, int(max_pixels // max(width * height, 1)))
+        if max_images:
+            per_batch = min(per_batch, max_images)
+        batches.extend(indices[start:start + per_batch] for start in range(0, len(indices), per_batch))
+    return batches
+
+
+def strip_bounds(height, tile_rows, min_rows=2):
+    """Split the image height into (top, bottom) row ranges of at most tile_rows"""
+    tile_rows = max(tile_rows, 16)
+    bounds = [(top, min(top + tile_rows, height)) for top in range(0, height, tile_rows)]
+    # Fold a tiny last strip into the previous one so spatial kernels always have room
+    if len(bounds) > 1 and bounds[-1][1] - bounds[-1][0] < min_rows:
+        bounds[-2] = (bounds[-2][0], bounds[-1][1])
+        bounds.pop()
+    return bounds
+
+
+class SegmentStats:
+    """Statistics of a fused segment's image as mapped by the tables composed so far.
+
+    Per-channel statistics come from the propagated histograms. Joint statistics
+    (the gray mean mixes channels per pixel) are measured in one streaming pass
+    over the segment input, so the result matches the unfused stages exactly.
+    """
+
+    def __init__(self, hist, strips, lut, pool=None, cache=None, cache_key=None):
+        self.hist = hist
+        self.pool = pool or buffer_pool
+        self.pixels = int(hist[0].sum())
+        self.lut = lut
+        self._strips = strips
+        self._gray_mean = None
+        self._cache = cache if cache_key is not None else None
+        self._cache_key = cache_key
+
+    def channel_means(self):
+        return (self.hist @ np.arange(256, dtype=np.int64)) / max(self.pixels, 1)
+
+    def channel_range(self):
+        """(mins, maxs) of each channel"""
+        mins, maxs = [], []
+        for counts in self.hist:
+            levels = np.flatnonzero(counts)
+            mins.append(int(levels[0]) if levels.size else 0)
+            maxs.append(int(levels[-1]) if levels.size else 0)
+        return mins, maxs
+
+    def channel_percentiles(self, low, high):
+        """(lows, highs): per channel, the levels below which low% and high% of the pixels fall.
+
+        (0, 100) gives the same levels as channel_range().
+        """
+        lows, highs = [], []
+        for counts in self.hist:
+            cdf = np.cumsum(counts)
+            total = cdf[-1]
+            if total == 0:
+                lows.append(0)
+                highs.append(0)
+                continue
+            lows.append(int(np.searchsorted(cdf, total * low / 100, side="right")))
+            highs.append(int(np.searchsorted(cdf, total * high / 100, side="left")))
+        return lows, highs
+
+    def gray_mean(self):
+        """Mean of cv2's RGB to gray conversion of the mapped image"""
+        if self._gray_mean is None and self._cache is not None:
+            key = ("gray_mean", self._cache_key, hashlib.sha1(self.lut.tobytes()).hexdigest())
+            self._gray_mean = self._cache.get_stat(key)
+        if self._gray_mean is None:
+            table = cv_lut(self.lut)
+            total = 0
+            for strip in self._strips():
+                mapped = cv2.LUT(strip, table, dst=self.pool.acquire(strip.shape))
+                gray = cv2.cvtColor(mapped, cv2.COLOR_RGB2GRAY, dst=self.pool.acquire(strip.shape[:2]))
+                total += int(gray.sum(dtype=np.int64))
+                self.pool.release(mapped)
+                self.pool.release(gray)
+            self._gray_mean = total / max(self.pixels, 1)
+            if self._cache is not None:
+                self._cache.put_stat(key, self._gray_mean)
+        return self._gray_mean
+
+
+# --- Built-in stages ---
+def contrast_params(brightness):
+    """Dynamically pick contrast/brightness (alpha, beta) based on brightness score"""
+    if brightness < 60:
+        return 1.4, 30   # higher contrast, brighten
+    elif brightness > 180:
+        return 0.9, -20  # reduce contrast a bit, darken
+    else:
+        return 1.2, 10
+
+
+@register_stage("gray_world", "pointwise")
+def gray_world_lut(stats, linear=False):
+    """Scale each channel so the channel means meet (Gray World assumption).
+
+    With linear, means and gains are taken in linear light, which keeps the
+    hues of saturated colors; the gains are folded into the table between
+    the sRGB decode and encode tables.
+    """
+    if not linear:
+        r_avg, g_avg, b_avg = stats.channel_means()
+        avg = (r_avg + g_avg + b_avg) / 3
+        return scale_lut([avg / m if m > 0 else 1 for m in (r_avg, g_avg, b_avg)])
+
+    means = (stats.hist @ SRGB_TO_LINEAR) / max(stats.pixels, 1)
+    gains = np.where(means > 0, means.mean() / np.where(means > 0, means, 1), 1)
+    scaled = np.rint(SRGB_TO_LINEAR[None, :] * gains[:, None] * (LINEAR_LEVELS - 1))
+    return LINEAR_TO_SRGB[np.clip(scaled, 0, LINEAR_LEVELS - 1).astype(np.intp)]
+
+
+@register_stage("gain", "pointwise")
+def gain_lut(stats, alpha=None, beta=None):
+    """Linear gain like cv2.convertScaleAbs; alpha/beta follow the brightness when not given"""
+    if alpha is None or beta is None:
+        auto_alpha, auto_beta = contrast_params(stats.gray_mean())
+        alpha = auto_alpha if alpha is None else alpha
+        beta = auto_beta if beta is None else beta
+    return scale_lut(alpha, beta)
+
+
+@register_stage("stretch", "pointwise")
+def stretch_lut(stats, low=0.0, high=100.0):
+    """Stretch each channel's low..high percentile range to 0..255, clipping what lies outside.
+
+    The default 0..100 is the plain min..max stretch; a small margin such as
+    0.5..99.5 keeps a few hot or dead pixels from defeating the stretch.
+    """
+    lut = identity_lut()
+    if low <= 0 and high >= 100:
+        lows, highs = stats.channel_range()
+    else:
+        lows, highs = stats.channel_percentiles(low, high)
+    for c, (min_val, max_val) in enumerate(zip(lows, highs)):
+        if max_val > min_val:
+            # Same expression as the per-pixel stretch, with levels outside the range clipped
+            clamped = np.clip(LEVELS, min_val, max_val)
+            lut[c] = np.uint8(255 * ((clamped - min_val) / (max_val - min_val)))
+    return lut
+
+
+def _blend_levels(base, factor):
+    # PIL's ImagingBlend in single precision, clipped and truncated to uint8
+    values = np.float32(base) + np.float32(factor) * (LEVELS.astype(np.float32) - np.float32(base))
+    return np.clip(values, 0, 255).astype(np.uint8)
+
+
+@register_stage("brightness", "pointwise")
+def brightness_lut(stats, factor=1.0):
+    """PIL ImageEnhance.Brightness (blend with black)"""
+    return np.tile(_blend_levels(0, factor), (3, 1))
+
+
+@register_stage("contrast", "pointwise")
+def contrast_lut(stats, factor=1.0):
+    """PIL ImageEnhance.Contrast (blend with the mean gray level)"""
+    return np.tile(_blend_levels(int(stats.gray_mean() + 0.5), factor), (3, 1))
+
+
+# PIL's ImageFilter.SMOOTH, the degenerate image ImageEnhance.Sharpness blends away from
+SMOOTH_KERNEL = np.array([[1, 1, 1], [1, 5, 1], [1, 1, 1]], dtype=np.float32) / 13
+
+
+def sharpen_kernel(factor):
+    """factor * identity + (1 - factor) * smooth: the Sharpness blend folded into one 3x3 kernel"""
+    kernel = (1 - factor) * SMOOTH_KERNEL
+    kernel[1, 1] += factor
+    return kernel
+
+
+@register_stage("sharpen", "spatial", halo=lambda params: 1, writes_dst=True)
+def sharpen(rgb, factor=1.3, dst=None):
+    """PIL ImageEnhance.Sharpness as a single cv2.filter2D pass (within 1 level of PIL).
+
+    Like PIL, the outermost rows and columns are left unfiltered.
+    """
+    dst = cv2.filter2D(rgb, -1, sharpen_kernel(factor), dst=dst, borderType=cv2.BORDER_REPLICATE)
+    if rgb.shape[0] > 2 and rgb.shape[1] > 2:
+        dst[0], dst[-1] = rgb[0], rgb[-1]
+        dst[:, 0], dst[:, -1] = rgb[:, 0], rgb[:, -1]
+    else:
+        dst[...] = rgb
+    return dst
+
+
+@register_stage("blur", "spatial", halo=lambda params: params.get("ksize", 3) // 2, writes_dst=True)
+def blur(rgb, ksize=3, sigma=0, dst=None):
+    """Gaussian blur"""
+    return cv2.GaussianBlur(rgb, (ksize, ksize), sigma, dst=dst)
+
+
+# Built-in configs: the bot's retouch, and the two legacy single-file variants
+PRESETS = {
+    "default": [
+        {"stage": "gray_world"},
+        {"stage": "gain"},
+        {"stage": "sharpen", "factor": 1.3},
+        {"stage": "stretch"},
+    ],
+    "opencv": [
+        {"stage": "gain", "alpha": 1.2, "beta": 7},
+        {"stage": "blur", "ksize": 3},
+    ],
+    "pil": [
+        {"stage": "brightness", "factor": 1.15},
+        {"stage": "contrast", "factor": 1.15},
+    ],
+    # The bot's retouch with gray world balanced in linear light
+    "linear": [
+        {"stage": "gray_world", "linear": True},
+        {"stage": "gain"},
+        {"stage": "sharpen", "factor": 1.3},
+        {"stage": "stretch"},
+    ],
+    # The bot's retouch with a stretch that ignores the darkest and brightest 0.5%
+    "robust": [
+        {"stage": "gray_world"},
+        {"stage": "gain"},
+        {"stage": "sharpen", "factor": 1.3},
+        {"stage": "stretch", "low": 0.5, "high": 99.5},
+    ],
+}
+
+
+# --- Compiled plans ---
+class Step:
+    """A configured stage"""
+
+    def __init__(self, stage_type, params, channels=None):
+        self.stage_type = stage_type
+        self.params = params
+        self.channels = channels
+
+    @property
+    def name(self):
+        return self.stage_type.name
+
+    @property
+    def kind(self):
+        return self.stage_type.kind
+
+    def halo(self):
+        halo = self.stage_type.halo
+        return halo(self.params) if callable(halo) else halo
+
+    def spec(self):
+        spec = {"stage": self.name, **self.params}
+        if self.channels is not None:
+            spec["channels"] = self.channels
+        return spec
+
+    def lut(self, stats):
+        table = self.stage_type.fn(stats, **self.params)
+        if self.channels is not None:
+            for c, channel in enumerate(CHANNELS):
+                if channel not in self.channels:
+                    table[c] = LEVELS
+        return table
+
+    def apply(self, image, pool=None):
+        if self.stage_type.writes_dst:
+            dst = (pool or buffer_pool).acquire(image.shape, image.dtype)
+            return self.stage_type.fn(image, dst=dst, **self.params)
+        return self.stage_type.fn(image, **self.params)
+
+
+class Segment:
+    """One unit of execution: a fused run of pointwise steps, or a single spatial/image step"""
+
+    def __init__(self, kind, steps):
+        self.kind = kind
+        self.steps = steps
+
+    @property
+    def name(self):
+        return "+".join(step.name for step in self.steps)
+
+    def halo(self):
+        return self.steps[0].halo() if self.kind == "spatial" else 0
+
+    def build_lut(self, hist, strips, pool=None, cache=None, cache_key=None):
+        """Compose the steps' tables; returns (table, histograms after the table).
+
+        With a cache, joint statistics of the segment input (named cache_key)
+        are memoized there.
+        """
+        composite = identity_lut()
+        for step in self.steps:
+            table = step.lut(SegmentStats(hist, strips, composite, pool, cache, cache_key))
+            composite = compose_luts(composite, table)
+            hist = propagate_histograms(hist, table)
+        return composite, hist
+
+    def apply(self, image, pool=None):
+        return self.steps[0].apply(image, pool)
+
+
+def _no_timer(name):
+    return contextlib.nullcontext()
+
+
+def config_signature(config):
+    return hashlib.sha256(json.dumps(config, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+
+class Plan:
+    def __init__(self, config, segments):
+        self.config = config
+        self.segments = segments
+        self.array_segments = [s for s in segments if s.kind != "image"]
+        self.image_segments = [s for s in segments if s.kind == "image"]
+        self.signature = config_signature(config)
+        # Key of the image after each array segment: plans sharing a prefix of stages share intermediates
+        specs = []
+        self.prefix_keys = []
+        for segment in self.array_segments:
+            specs.extend(step.spec() for step in segment.steps)
+            self.prefix_keys.append(config_signature(specs))
+
+    @property
+    def tileable(self):
+        return all(s.halo() is not None for s in self.array_segments if s.kind == "spatial")
+
+    def describe(self):
+        return " -> ".join(f"[{s.name}]" if s.kind == "lut" else s.name for s in self.segments)
+
+    def split_image_stages(self):
+        """(plan of the array stages, plan of the trailing image stages); the second is None without any"""
+        count = len(self.image_segments)
+        if not count:
+            return self, None
+        return compile_plan(self.config[:-count]), compile_plan(self.config[-count:])
+
+    def run(self, image, timer=None, pool=None, cache=None):
+        """Run the plan on a PIL image (or RGB array) and return a PIL image"""
+        pool = pool or buffer_pool
+        rgb = np.asarray(image.convert("RGB") if isinstance(image, Image.Image) and image.mode != "RGB" else image)
+        result = self.run_array(rgb, timer, pool, cache)
+        try:
+            # Image.fromarray copies, so the buffer can go back to the pool right away
+            return self._finish(result, timer)
+        finally:
+            if result is not rgb:
+                pool.release(result)
+
+    def run_array(self, rgb, timer=None, pool=None, cache=None):
+        """Run the array segments on an RGB uint8 array (the input is never modified).
+
+        Intermediates are pooled buffers; the returned array belongs to the
+        caller, who may hand it back with pool.release() when done with it.
+
+        cache (a StageCacheScope for this image) memoizes segment outputs and
+        input statistics by stage prefix: a rerun starts from the longest
+        cached prefix, and only segments whose stages or parameters changed
+        are recomputed. The last segment's output goes to the caller rather
+        than the cache; cached outputs are read-only, and so may be the result
+        when a longer plan cached this plan's whole prefix.
+        """
+        pool = pool or buffer_pool
+        timer = timer or _no_timer
+        current = rgb
+        start = 0
+        if cache is not None:
+            for end in range(len(self.array_segments), 0, -1):
+                cached = cache.get_array(("output", self.prefix_keys[end - 1]))
+                if cached is not None:
+                    current, start = cached, end
+                    break
+
+        for i in range(start, len(self.array_segments)):
+            segment = self.array_segments[i]
+            input_key = self.prefix_keys[i - 1] if i else "input"
+            with timer(segment.name):
+                if segment.kind == "lut":
+                    source = current
+                    hist = cache.get_stat(("hist", input_key)) if cache is not None else None
+                    if hist is None:
+                        hist = channel_histograms(array_strips(source))
+                        if cache is not None:
+                            cache.put_stat(("hist", input_key), hist)
+                    table, _ = segment.build_lut(hist, lambda: array_strips(source), pool, cache, input_key)
+                    # Map in place once we own a writable intermediate
+                    owned = current is not rgb and current.flags.writeable
+                    dst = current if owned else pool.acquire(current.shape)
+                    current = cv2.LUT(current, cv_lut(table), dst=dst)
+                else:
+                    result = segment.apply(current, pool)
+                    if current is not rgb:
+                        pool.release(current)
+                    current = result
+            if cache is not None and current is not rgb and i < len(self.array_segments) - 1:
+                # The cache takes the buffer over (read-only), so the next segment maps into a new one
+                cache.put_array(("output", self.prefix_keys[i]), current)
+        return current
+
+    def run_batch(self, images, timer=None, max_batch_pixels=BATCH_MAX_PIXELS, pool=None):
+        """Run the plan on several images and return PIL results in input order.
+
+        Same-size images are stacked into (N, H, W, 3) batches that are processed
+        in place: one vectorized histogram pass per pointwise segment for the
+        whole batch, and per-image tables applied slice by slice with cv2.LUT.
+        """
+        pool = pool or buffer_pool
+        images = [image.convert("RGB") if isinstance(image, Image.Image) and image.mode != "RGB" else image
+                  for image in images]
+        sizes = [image.size if isinstance(image, Image.Image) else image.shape[1::-1] for image in images]
+        results = [None] * len(images)
+        for indices in batch_buckets(sizes, max_batch_pixels):
+            width, height = sizes[indices[0]]
+            batch = pool.acquire((len(indices), height, width, 3))
+            for slot, index in enumerate(indices):
+                batch[slot] = np.asarray(images[index])
+            self.run_array_batch(batch, timer, pool)
+            for slot, index in enumerate(indices):
+                results[index] = self._finish(batch[slot], timer)
+            pool.release(batch)
+        return results
+
+    def run_array_batch(self, batch, timer=None, pool=None):
+        """Run the array segments in place on an (N, H, W, 3) uint8 batch"""
+        pool = pool or buffer_pool
+        timer = timer or _no_timer
+        for segment in self.array_segments:
+            with timer(segment.name):
+                if segment.kind == "lut":
+                    hists = batch_histograms(batch)
+                    for slot in range(len(batch)):
+                        image = batch[slot]
+                        table, _ = segment.build_lut(hists[slot], lambda image=image: array_strips(image), pool)
+                        cv2.LUT(image, cv_lut(table), dst=image)
+                else:
+                    for slot in range(len(batch)):
+                        result = segment.apply(batch[slot], pool)
+                        batch[slot] = result
+                        pool.release(result)
+        return batch
+
+    def run_tiled(self, image, tile_rows, timer=None, pool=None):
+        """Same output as run(), computed in horizontal strips with bounded memory.
+
+        Tables of pointwise segments are resolved by streaming the earlier steps
+        over the strips; the output pass then runs every step on each strip (with
+        enough overlap for the spatial steps) and the trailing pointwise segment
+        is applied in place. Besides the input and the output, only one strip of
+        intermediates is held at a time, and strip buffers are reused throughout.
+        """
+        if not self.tileable:
+            return self.run(image, timer, pool)
+        pool = pool or buffer_pool
+        timer = timer or _no_timer
+        if isinstance(image, Image.Image):
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            width, height = image.size
+            read = lambda top, bottom: np.asarray(image.crop((0, top, width, bottom)))
+        else:
+            height, width = image.shape[:2]
+            read = lambda top, bottom: image[top:bottom]
+
+        halo_total = sum(s.halo() for s in self.array_segments if s.kind == "spatial")
+        bounds = strip_bounds(height, tile_rows, min_rows=max(2, halo_total))
+
+        def run_rows(top, bottom, ops):
+            """Rows top..bottom after ops, plus the pooled buffer holding them (or None)"""
+            halo = sum(op.halo() for kind, op in ops if kind == "spatial")
+            pad_top, pad_bottom = max(top - halo, 0), min(bottom + halo, height)
+            strip = read(pad_top, pad_bottom)
+            owned = None
+            for kind, op in ops:
+                if kind == "lut":
+                    strip = owned = cv2.LUT(strip, op, dst=owned if owned is not None else pool.acquire(strip.shape))
+                else:
+                    result = op.apply(strip, pool)
+                    pool.release(owned)
+                    strip = owned = result
+            return strip[top - pad_top:bottom - pad_top], owned
+
+        def prefix_strips(prefix):
+            for top, bottom in bounds:
+                rows, owned = run_rows(top, bottom, prefix)
+                yield rows
+                pool.release(owned)
+
+        # Resolve every pointwise segment except a trailing one by streaming its prefix
+        segments = list(self.array_segments)
+        tail = segments.pop() if segments and segments[-1].kind == "lut" else None
+        ops = []
+        for segment in segments:
+            if segment.kind == "lut":
+                strips = lambda prefix=list(ops): prefix_strips(prefix)
+                with timer(f"{segment.name}_stats"):
+                    table, _ = segment.build_lut(channel_histograms(strips()), strips, pool)
+                ops.append(("lut", cv_lut(table)))
+            else:
+                ops.append(("spatial", segment))
+
+        # Output pass, gathering the trailing segment's histograms on the way
+        output = pool.acquire((height, width, 3))
+        hist = np.zeros((3, 256), dtype=np.int64)
+        with timer("tiled_output"):
+            for top, bottom in bounds:
+                rows, owned = run_rows(top, bottom, ops)
+                output[top:bottom] = rows
+                pool.release(owned)
+                if tail is not None:
+                    hist += channel_histograms(array_strips(output[top:bottom]))
+
+        if tail is not None:
+            with timer(tail.name):
+                table, _ = tail.build_lut(hist, lambda: array_strips(output), pool)
+                table = cv_lut(table)
+                for top, bottom in bounds:
+                    cv2.LUT(output[top:bottom], table, dst=output[top:bottom])
+        try:
+            return self._finish(output, timer)
+        finally:
+            pool.release(output)
+
+    def _finish(self, rgb, timer):
+        timer = timer or _no_timer
+        result = Image.fromarray(rgb)
+        for segment in self.image_segments:
+            with timer(segment.name):
+                result = segment.apply(result)
+        return result
+
+
+def compile_plan(config, stages=None):
+    """Compile a list of stage specs (dicts, or bare stage names) into a Plan"""
+    stages = STAGES if stages is None else stages
+    normalized = []
+    steps = []
+    for spec in config:
+        spec = {"stage": spec} if isinstance(spec, str) else dict(spec)
+        normalized.append(dict(spec))
+        name = spec.pop("stage")
+        channels = spec.pop("channels", None)
+        stage_type = stages.get(name)
+        if stage_type is None:
+            raise ValueError(f"Unknown pipeline stage: {name}")
+        if channels is not None and stage_type.kind != "pointwise":
+            raise ValueError(f"Stage {name} cannot be limited to channels")
+        if steps and steps[-1].kind == "image" and stage_type.kind != "image":
+            raise ValueError(f"Stage {name} cannot follow an image stage")
+        steps.append(Step(stage_type, spec, channels))
+
+    segments = []
+    for step in steps:
+        if step.kind == "pointwise" and segments and segments[-1].kind == "lut":
+            segments[-1].steps.append(step)
+        else:
+            segments.append(Segment("lut" if step.kind == "pointwise" else step.kind, [step]))
+    return Plan(normalized, segments)
+
+
+def load_config(value):
+    """Resolve a preset name, a stage list or a JSON string to a stage list"""
+    if isinstance(value, str):
+        if value in PRESETS:
+            return PRESETS[value]
+        value = json.loads(value)
+    if not isinstance(value, list):
+        raise ValueError("A pipeline config must be a preset name or a list of stages")
+    return value
@@ -2,7 +2,7 @@ import discord
 from discord import ui, ButtonStyle, File
 from discord.ext import commands
 import asyncio
-from PIL import Image, ImageDraw, ImageFont, ImageEnhance
+from PIL import Image, ImageDraw, ImageFont
 import cv2
 import numpy as np
 from google.oauth2.service_account import Credentials
@@ -15,6 +15,21 @@ import tempfile
 from dotenv import load_dotenv
 import re
 import sys
+import hashlib
+import threading
+import json
+import time
+import math
+import concurrent.futures
+import collections
+import functools
+import contextvars
+import weakref
+from contextlib import contextmanager
+import metrics
+import tracing
+import pipeline
+import loop_watchdog
 
 load_dotenv()
 
@@ -23,6 +38,80 @@ CHANNEL_ID = int(os.getenv("CHANNEL_ID", "0"))
 CREDENTIALS_FILE = os.getenv("CREDENTIALS_FILE") 
 UPLOAD_FOLDER_ID = os.getenv("GOOGLE_FOLDER_ID")
 WATERMARK_PATH = os.getenv("WATERMARK_PATH", "Water_Mark.png")
+RETOUCH_CACHE_DIR = os.getenv("RETOUCH_CACHE_DIR", ".retouch_cache")
+RETOUCH_CACHE_MAX_MB = int(os.getenv("RETOUCH_CACHE_MAX_MB", "2048"))
+
+# Bump whenever the output of retouch_image changes so stale cache entries are ignored
+PIPELINE_VERSION = "2"
+
+PHASH_INDEX_PATH = os.getenv("PHASH_INDEX_PATH", "phash_index.json")
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))
+PHASH_INDEX_SUPPLIES = int(os.getenv("PHASH_INDEX_SUPPLIES", "200"))
+SKIP_NEAR_DUPLICATES = os.getenv("SKIP_NEAR_DUPLICATES", "0") == "1"
+
+# Retouch same-size images of an upload as stacked (N, H, W, 3) batches instead of one job per image
+BATCH_RETOUCH = os.getenv("BATCH_RETOUCH", "0") == "1"
+BATCH_MAX_MEGAPIXELS = float(os.getenv("BATCH_MAX_MEGAPIXELS", "100"))
+
+# Optional JSON file declaring the retouch pipeline, globally and per channel (see load_pipeline_plans)
+PIPELINE_CONFIG = os.getenv("PIPELINE_CONFIG")
+
+# Balance colors in linear light instead of on gamma-encoded sRGB values (default pipeline and gray world)
+LINEAR_LIGHT = os.getenv("LINEAR_LIGHT", "0") == "1"
+
+# Intermediates kept (across all QC sessions) so "Retouch Again" and tuning only redo the stages that changed
+STAGE_CACHE_MAX_MB = int(os.getenv("STAGE_CACHE_MAX_MB", "512"))
+
+# Scratch buffers each worker thread keeps between images (see pipeline.BufferPool)
+BUFFER_POOL_MAX_MB = int(os.getenv("BUFFER_POOL_MAX_MB", "256"))
+pipeline.buffer_pool.max_bytes = BUFFER_POOL_MAX_MB * 1024 * 1024
+
+# Images at or above this size are retouched strip by strip to bound peak memory (0 disables)
+TILED_MIN_MEGAPIXELS = float(os.getenv("TILED_MIN_MEGAPIXELS", "40"))
+TILE_ROWS = int(os.getenv("TILE_ROWS", "512"))
+
+# Denoiser used by "Retouch Again": nlmeans, nlmeans_guided, bilateral or edge_preserving
+RETOUCH_AGAIN_DENOISER = os.getenv("RETOUCH_AGAIN_DENOISER", "nlmeans_guided")
+DENOISE_TIME_BUDGET = float(os.getenv("DENOISE_TIME_BUDGET", "2.0"))
+
+# "Tune" previews re-render a proxy with this long edge, giving denoising this many seconds
+TUNING_PROXY_EDGE = int(os.getenv("TUNING_PROXY_EDGE", "1024"))
+TUNING_PREVIEW_BUDGET = float(os.getenv("TUNING_PREVIEW_BUDGET", "0.15"))
+
+# Auto-QC: retouches scoring at least this confidence (0..1) are pre-marked passed (0 disables)
+AUTO_QC_THRESHOLD = float(os.getenv("AUTO_QC_THRESHOLD", "0"))
+AUTO_QC_PROXY_EDGE = int(os.getenv("AUTO_QC_PROXY_EDGE", "512"))
+# Share of pixels allowed at pure black/white (raise it for product shots on white backgrounds)
+AUTO_QC_MAX_CLIPPED = float(os.getenv("AUTO_QC_MAX_CLIPPED", "0.05"))
+
+# Speculative "Retouch Again": off, failed (when an image is marked Not Pass) or all (at ingest)
+SPECULATIVE_RETOUCH = os.getenv("SPECULATIVE_RETOUCH", "failed")
+# With "all", stop queueing ingest-time speculation once this many speculative jobs are waiting
+SPECULATIVE_MAX_PENDING = int(os.getenv("SPECULATIVE_MAX_PENDING", "4"))
+
+SCHEDULER_WORKERS = int(os.getenv("SCHEDULER_WORKERS", str(os.cpu_count() or 2)))
+SCHEDULER_MAX_QUEUE = int(os.getenv("SCHEDULER_MAX_QUEUE", "64"))
+
+# Send the QC message as soon as the first image is ready instead of waiting for all of them
+PROGRESSIVE_INGEST = os.getenv("PROGRESSIVE_INGEST", "1") == "1"
+
+# Local Prometheus-style metrics endpoint (0 disables)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+# Per-session span traces are appended here as JSON lines when a session ends
+TRACE_LOG_PATH = os.getenv("TRACE_LOG_PATH", "session_traces.jsonl")
+
+# Watch-folder ingest: files dropped into WATCH_FOLDER/<supply_id>/ are processed and posted for QC
+WATCH_FOLDER = os.getenv("WATCH_FOLDER")
+WATCH_CHANNEL_ID = int(os.getenv("WATCH_CHANNEL_ID", str(CHANNEL_ID)))
+WATCH_POLL_SECONDS = float(os.getenv("WATCH_POLL_SECONDS", "2"))
+# A supply folder is posted once no file in it has changed for this long
+WATCH_SETTLE_SECONDS = float(os.getenv("WATCH_SETTLE_SECONDS", "10"))
+WATCH_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".webp")
+
+# Log the stack of any callback that blocks the event loop longer than this (0 disables the watchdog)
+LOOP_WATCHDOG_MS = int(os.getenv("LOOP_WATCHDOG_MS", "0"))
 
 if CREDENTIALS_FILE is None:
     print("WARNING: GOOGLE_CREDENTIALS_FILE environment variable is not set.")
@@ -34,6 +123,8 @@ elif not os.path.exists(CREDENTIALS_FILE):
 SCOPES = ['https://www.googleapis.com/auth/drive.file']
 
 active_sessions = {}
+retouch_stage_cache = pipeline.StageCache(STAGE_CACHE_MAX_MB * 1024 * 1024)
+
 class ImageQCSession:
     def __init__(self, message_id, supply_id, original_images, user_id):
         self.message_id = message_id
@@ -48,108 +139,713 @@ class ImageQCSession:
         self.folder_link = None
         self.feedback = {} 
         self.passed_images = [] 
+        self.duplicate_notes = {}
+        self.skipped_duplicates = []
+        self.speculative_retouches = {}
+        self.image_ready = []
+        self.ingest_tasks = []
+        self.processing_errors = {}
+        self.trace = tracing.SessionTrace(supply_id, user_id)
+        self.ingest_span = None
+        self.plan = DEFAULT_PLAN
+        self.stage_cache_owner = object()
+        self.tuning_proxies = {}
+        self.auto_qc = {}
+        self.auto_passed = set()
+        self.completed_by_auto_qc = False
+        self.finalize_lock = asyncio.Lock()
+        self.finalized = asyncio.Event()
+        self.contact_sheet = False
+        self.thumbnails = None
+        self.thumbnail_sources = []
+
+    def stage_cache_for(self, index, arrays=True):
+        """Cached statistics and intermediates of one image, shared by all its retouches.
+
+        Ingest passes arrays=False: the default plan shares no stage prefix with
+        the 'Retouch Again' and tuning plans, so only its statistics get reused.
+        """
+        return retouch_stage_cache.scope(index, owner=self.stage_cache_owner, arrays=arrays)
+
+    def tuning_proxy(self, index):
+        """Downscaled original used for live tuning previews, made once per image"""
+        proxy = self.tuning_proxies.get(index)
+        if proxy is None:
+            proxy = self.tuning_proxies[index] = make_proxy(self.original_images[index], TUNING_PROXY_EDGE)
+        return proxy
+
+    def replace_retouch(self, index, retouched, watermarked):
+        """Swap in a new retouch of an image and put it back up for review"""
+        self.processed_images_no_watermark[index] = retouched
+        self.processed_images[index] = watermarked
+        self.qc_status[index] = None
+        if index in self.passed_images:
+            self.passed_images.remove(index)
+        self.auto_qc.pop(index, None)
+        self.auto_passed.discard(index)
+        self.current_index = index
+
+    def apply_auto_qc(self, index, score, image):
+        """Record the auto-QC score of image and pre-mark it passed if no reviewer has decided on it yet.
+
+        A score that arrives after a retouch replaced image belongs to the old version and is dropped.
+        """
+        if self.processed_images_no_watermark[index] is not image:
+            return
+        self.auto_qc[index] = score
+        if score["confidence"] >= AUTO_QC_THRESHOLD and self.qc_status[index] is None:
+            self.qc_status[index] = True
+            self.passed_images.append(index)
+            self.auto_passed.add(index)
+            AUTO_QC_RESULTS.inc(result="passed")
+            # Nobody is left to click the last "Pass QC", so the session is finalized after ingest
+            if self.is_complete():
+                self.completed_by_auto_qc = True
+        else:
+            AUTO_QC_RESULTS.inc(result="review")
+
+    def thumbnail_stack(self):
+        """(N, cell, cell, 3) thumbnails of the processed images; made once per image and retouch.
+
+        Runs on a worker while retouches are swapped in on the event loop, so each
+        thumbnail remembers (weakly) the image object it was made from and is
+        redone whenever the slot holds a different one.
+        """
+        count = len(self.processed_images)
+        cell = CONTACT_SHEET_CELL
+        if self.thumbnails is None or len(self.thumbnails) != count:
+            self.thumbnails = np.full((count, cell, cell, 3), CONTACT_SHEET_BACKGROUND, dtype=np.uint8)
+            self.thumbnail_sources = [None] * count
+        for index, image in enumerate(list(self.processed_images)):
+            source = self.thumbnail_sources[index]
+            if image is not None and self.is_ready(index) and (source is None or source() is not image):
+                self.thumbnails[index] = make_thumbnail(image, cell)
+                self.thumbnail_sources[index] = weakref.ref(image)
+        return self.thumbnails
+
+    def mark_passed(self, index):
+        self.qc_status[index] = True
+        self.auto_passed.discard(index)
+        if index not in self.passed_images:
+            self.passed_images.append(index)
+
+    def pending_indices(self):
+        """Images nobody has decided on yet, starting from the current one"""
+        pending = [i for i, status in enumerate(self.qc_status) if status is None]
+        return sorted(pending, key=lambda i: (i < self.current_index, i))
+
+    def next_index_for_review(self, after):
+        """The next image after `after` that was not auto-passed, or None"""
+        for index in range(after + 1, len(self.qc_status)):
+            if index not in self.auto_passed:
+                return index
+        return None
+
+    def is_ready(self, index):
+        return not self.image_ready or self.image_ready[index].is_set()
+
+    async def wait_for_image(self, index):
+        """Wait until a progressively ingested image has been processed"""
+        if self.image_ready:
+            await self.image_ready[index].wait()
+
+    async def wait_until_ingested(self):
+        await asyncio.gather(*(event.wait() for event in self.image_ready))
     
+    def start_speculative_retouch(self, index, budgeted=False):
+        """Precompute the aggressive 'Retouch Again' variant of an image in the background.
+
+        budgeted skips the image once SPECULATIVE_MAX_PENDING speculative jobs are already waiting.
+        """
+        if SPECULATIVE_RETOUCH == "off" or index in self.speculative_retouches:
+            return
+        if budgeted and scheduler.depth[PRIORITY_SPECULATIVE] >= SPECULATIVE_MAX_PENDING:
+            return
+        try:
+            future = scheduler.submit(
+                PRIORITY_SPECULATIVE, self.user_id, aggressive_variant, self.original_images[index],
+                self.stage_cache_for(index), self.plan
+            )
+        except QueueFullError:
+            return
+        self.speculative_retouches[index] = future
+
+    def take_speculative_retouch(self, index):
+        return self.speculative_retouches.pop(index, None)
+
+    def close(self):
+        """Cancel ingest and speculative work that is still pending and write the session trace"""
+        for task in self.ingest_tasks:
+            task.cancel()
+        for future in self.speculative_retouches.values():
+            future.cancel()
+        self.speculative_retouches.clear()
+        retouch_stage_cache.clear(self.stage_cache_owner)
+        self.tuning_proxies.clear()
+        self.thumbnails = None
+
+        self.trace.session_id = self.message_id
+        try:
+            self.trace.write(TRACE_LOG_PATH)
+        except Exception as e:
+            print(f"Error writing session trace: {e}")
+
+    def memory_bytes(self):
+        """Approximate bytes held by this session's decoded images and cached intermediates"""
+        total = retouch_stage_cache.owner_nbytes(self.stage_cache_owner)
+        for images in (self.original_images, self.processed_images, self.processed_images_no_watermark,
+                       list(self.tuning_proxies.values())):
+            for image in images:
+                if image is not None:
+                    total += image.width * image.height * len(image.getbands())
+        if self.thumbnails is not None:
+            total += self.thumbnails.nbytes
+        return total
+
     def is_complete(self):
         return all(status is not None for status in self.qc_status)
     
     def all_passed(self):
         return all(status is True for status in self.qc_status)
 
+# --- Metrics ---
+STAGE_SECONDS = metrics.registry.histogram(
+    "retoucher_stage_seconds", "Duration of image pipeline stages", ["stage"]
+)
+IO_SECONDS = metrics.registry.histogram(
+    "retoucher_io_seconds", "Duration of Discord and Google Drive calls", ["operation"]
+)
+IO_BYTES = metrics.registry.counter(
+    "retoucher_io_bytes_total", "Bytes transferred by Discord and Google Drive calls", ["operation"]
+)
+STAGE_ERRORS = metrics.registry.counter(
+    "retoucher_stage_errors_total", "Exceptions raised by pipeline stages and I/O calls", ["stage"]
+)
+CACHE_LOOKUPS = metrics.registry.counter(
+    "retoucher_cache_lookups_total", "Retouch cache lookups", ["result"]
+)
+JOB_WAIT_SECONDS = metrics.registry.histogram(
+    "retoucher_job_wait_seconds", "Time jobs spend queued in the scheduler", ["priority"]
+)
+LOOP_LAG_SECONDS = metrics.registry.histogram(
+    "retoucher_event_loop_lag_seconds", "How late the event loop woke the watchdog heartbeat",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+)
+LOOP_STALLS = metrics.registry.counter(
+    "retoucher_event_loop_stalls_total", "Callbacks that blocked the event loop past LOOP_WATCHDOG_MS"
+)
+AUTO_QC_RESULTS = metrics.registry.counter(
+    "retoucher_auto_qc_images_total", "Images scored by auto-QC, by whether they were pre-marked passed", ["result"]
+)
+metrics.registry.gauge(
+    "retoucher_active_sessions", "QC sessions currently open",
+    callback=lambda: len(active_sessions)
+)
+metrics.registry.gauge(
+    "retoucher_session_memory_bytes", "Approximate decoded image memory per QC session", ["supply_id"],
+    callback=lambda: {(session.supply_id,): session.memory_bytes() for session in list(active_sessions.values())}
+)
+metrics.registry.gauge(
+    "retoucher_queue_depth", "Jobs waiting in the scheduler", ["priority"],
+    callback=lambda: {(name,): stats["depth"] for name, stats in scheduler.metrics().items()}
+)
+metrics.registry.gauge(
+    "retoucher_jobs_running", "Jobs currently running on scheduler workers", ["priority"],
+    callback=lambda: {(name,): stats["running"] for name, stats in scheduler.metrics().items()}
+)
+BUFFER_POOL_REQUESTS = metrics.registry.counter(
+    "retoucher_buffer_pool_requests_total", "Pipeline scratch buffers newly allocated vs. reused from the pool", ["result"]
+)
+pipeline.buffer_pool.on_acquire = lambda result: BUFFER_POOL_REQUESTS.inc(result=result)
+
+def timed_stage(stage, histogram=STAGE_SECONDS, label="stage", size=None):
+    """Decorator recording a function's duration (and exceptions) as a metric and a trace span.
+
+    size(args, result) may return the number of bytes the call handled.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = None
+            try:
+                result = fn(*args, **kwargs)
+                return result
+            except Exception:
+                STAGE_ERRORS.inc(stage=stage)
+                raise
+            finally:
+                duration = time.perf_counter() - start
+                histogram.observe(duration, **{label: stage})
+                nbytes = size(args, result) if size is not None and result is not None else None
+                tracing.record_span(stage, start, duration, bytes=nbytes)
+        return wrapper
+    return decorator
+
+def timed_io(operation, size=None):
+    return timed_stage(operation, histogram=IO_SECONDS, label="operation", size=size)
+
+@contextmanager
+def stage_timer(stage):
+    """Time a block of pipeline code as a metric and a trace span"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=stage)
+        tracing.record_span(stage, start, duration)
+
+def observe_io(operation, start, nbytes=None):
+    """Record an awaited Discord call that started at time.perf_counter() value start"""
+    duration = time.perf_counter() - start
+    IO_SECONDS.observe(duration, operation=operation)
+    if nbytes is not None:
+        IO_BYTES.inc(nbytes, operation=operation)
+    tracing.record_span(operation, start, duration, bytes=nbytes)
+
 # --- Image Processing Functions ---
+GRAY_WORLD_PLAN = pipeline.compile_plan([{"stage": "gray_world", "linear": LINEAR_LIGHT}])
+STRETCH_PLAN = pipeline.compile_plan(["stretch"])
+
+@timed_stage("gray_world")
 def apply_gray_world(image):
     """Apply Gray World color correction algorithm to an image"""
-    # Convert PIL image to OpenCV format
-    cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-    
-    # Split the image into its BGR components
-    b, g, r = cv2.split(cv_image)
-    
-    # Calculate the average of each channel
-    r_avg = np.mean(r)
-    g_avg = np.mean(g)
-    b_avg = np.mean(b)
-    
-    # Calculate the average gray value
-    avg = (r_avg + g_avg + b_avg) / 3
-    
-    # Calculate the scaling factors
-    r_scale = avg / r_avg if r_avg > 0 else 1
-    g_scale = avg / g_avg if g_avg > 0 else 1
-    b_scale = avg / b_avg if b_avg > 0 else 1
-    
-    # Apply the scaling factors
-    r = cv2.convertScaleAbs(r, alpha=r_scale)
-    g = cv2.convertScaleAbs(g, alpha=g_scale)
-    b = cv2.convertScaleAbs(b, alpha=b_scale)
-    
-    # Merge the channels back
-    balanced_image = cv2.merge([b, g, r])
-    
-    # Convert back to PIL image
-    return Image.fromarray(cv2.cvtColor(balanced_image, cv2.COLOR_BGR2RGB))
+    return GRAY_WORLD_PLAN.run(image)
 
+@timed_stage("stretch")
 def component_stretching(image):
     """Apply contrast stretching to each color channel"""
-    # Convert PIL image to OpenCV format
-    cv_image = cv2.cvtColor(np.array(image), cv2.COLOR_RGB2BGR)
-    
-    # Split the image into its BGR components
-    b, g, r = cv2.split(cv_image)
-    
-    # Apply histogram stretching to each channel
-    channels = []
-    for channel in [b, g, r]:
-        min_val = np.min(channel)
-        max_val = np.max(channel)
-        
-        # Avoid division by zero
-        if max_val > min_val:
-            stretched = np.uint8(255 * ((channel - min_val) / (max_val - min_val)))
-        else:
-            stretched = channel
-            
-        channels.append(stretched)
-        
-    # Merge the channels back
-    stretched_image = cv2.merge([channels[0], channels[1], channels[2]])
-    
-    # Convert back to PIL image
-    return Image.fromarray(cv2.cvtColor(stretched_image, cv2.COLOR_BGR2RGB))
-
-def retouch_image(pil_image):
-    # Apply Gray World assumption for color balance
-    balanced_image = apply_gray_world(pil_image)
-
-    # Convert to OpenCV format
-    cv_image = cv2.cvtColor(np.array(balanced_image), cv2.COLOR_RGB2BGR)
-    gray = cv2.cvtColor(cv_image, cv2.COLOR_BGR2GRAY)
-    brightness = np.mean(gray)
-
-    # Dynamically adjust contrast/brightness based on brightness score
-    if brightness < 60:
-        alpha = 1.4  # higher contrast
-        beta = 30    # brighten
-    elif brightness > 180:
-        alpha = 0.9  # reduce contrast a bit
-        beta = -20   # darken
+    return STRETCH_PLAN.run(image)
+
+contrast_params = pipeline.contrast_params
+
+def retouch_image(pil_image, plan=None, cache=None):
+    """Retouch an image with a compiled pipeline plan (the default plan unless given).
+
+    cache is the image's session stage cache (see ImageQCSession.stage_cache_for).
+    """
+    # Image stages (a configured watermark) only go on the delivered copy, see watermark_with
+    plan = split_plan(plan or DEFAULT_PLAN)[0]
+
+    # Very large images go through the bounded-memory tiled path, which keeps no intermediates
+    if TILED_MIN_MEGAPIXELS > 0 and pil_image.width * pil_image.height >= TILED_MIN_MEGAPIXELS * 1_000_000:
+        return retouch_image_tiled(pil_image, plan=plan)
+
+    return plan.run(pil_image, timer=stage_timer, cache=cache)
+
+# --- Denoising ---
+def _denoise_nlmeans(image):
+    return cv2.fastNlMeansDenoisingColored(image, None, 10, 10, 7, 21)
+
+def _denoise_bilateral(image):
+    return cv2.bilateralFilter(image, 9, 50, 50)
+
+def _denoise_edge_preserving(image):
+    return cv2.edgePreservingFilter(image, flags=cv2.RECURS_FILTER, sigma_s=40, sigma_r=0.25)
+
+DENOISERS = {
+    "nlmeans": _denoise_nlmeans,
+    "nlmeans_guided": _denoise_nlmeans,
+    "bilateral": _denoise_bilateral,
+    "edge_preserving": _denoise_edge_preserving,
+}
+
+# Measured throughput in pixels per second, seeded with conservative guesses
+_denoise_throughput = {
+    "nlmeans_guided": 1.5e6,
+    "bilateral": 2e7,
+    "edge_preserving": 1e7,
+}
+_denoise_lock = threading.Lock()
+
+def denoise(bgr_image, method=RETOUCH_AGAIN_DENOISER, budget=DENOISE_TIME_BUDGET):
+    """Denoise a BGR image, working on a downscaled guide when full resolution would exceed the budget.
+
+    "nlmeans" is the full-resolution reference and ignores the budget. The other
+    methods pick a working scale from their measured throughput; when downscaled,
+    only the removed noise (the residual) is upsampled and subtracted at full size.
+    """
+    denoiser = DENOISERS.get(method)
+    if denoiser is None:
+        raise ValueError(f"Unknown denoiser: {method}")
+    if method == "nlmeans":
+        return denoiser(bgr_image)
+
+    height, width = bgr_image.shape[:2]
+    pixels = width * height
+    with _denoise_lock:
+        throughput = _denoise_throughput[method]
+    scale = 1.0
+    if budget > 0:
+        scale = min(1.0, math.sqrt(throughput * budget / pixels))
+
+    start = time.perf_counter()
+    if scale >= 1.0:
+        result = denoiser(bgr_image)
+        worked_pixels = pixels
     else:
-        alpha = 1.2
-        beta = 10
+        small_size = (max(1, int(width * scale)), max(1, int(height * scale)))
+        small = cv2.resize(bgr_image, small_size, interpolation=cv2.INTER_AREA)
+        denoised_small = denoiser(small)
+        residual = cv2.subtract(small, denoised_small, dtype=cv2.CV_16S)
+        residual = cv2.resize(residual, (width, height), interpolation=cv2.INTER_LINEAR)
+        result = cv2.subtract(bgr_image, residual, dtype=cv2.CV_8U)
+        worked_pixels = small_size[0] * small_size[1]
+    elapsed = time.perf_counter() - start
+
+    # Update the throughput estimate so the next call fits the budget better
+    if elapsed > 0:
+        with _denoise_lock:
+            _denoise_throughput[method] = 0.7 * throughput + 0.3 * (worked_pixels / elapsed)
+    if budget > 0 and elapsed > budget:
+        print(f"Denoise '{method}' took {elapsed:.2f}s (budget {budget:.2f}s) at scale {scale:.2f}")
+    return result
+
+@timed_stage("aggressive_variant")
+def aggressive_variant(pil_image, cache=None, channel_plan=None):
+    """Return (retouched, watermarked) for the 'Retouch Again' preset, watermarked as channel_plan does"""
+    retouched = retouch_image_aggressive(pil_image, cache=cache)
+    return retouched, watermark_with(channel_plan, retouched)
+
+@pipeline.register_stage("denoise", "spatial", halo=None)
+def denoise_stage(rgb, method=RETOUCH_AGAIN_DENOISER, budget=DENOISE_TIME_BUDGET):
+    """Pipeline stage running denoise() on an RGB array"""
+    bgr = cv2.cvtColor(rgb, cv2.COLOR_RGB2BGR)
+    return cv2.cvtColor(denoise(bgr, method, budget), cv2.COLOR_BGR2RGB)
+
+# Stronger preset used by the 'Retouch Again' button
+AGGRESSIVE_PIPELINE = [
+    {"stage": "gain", "alpha": 1.3, "beta": 15},
+    {"stage": "denoise"},
+    {"stage": "sharpen", "factor": 2.0},
+    {"stage": "stretch"},
+]
+
+@functools.lru_cache(maxsize=None)
+def aggressive_plan(denoiser):
+    config = [dict(spec) for spec in AGGRESSIVE_PIPELINE]
+    config[1]["method"] = denoiser
+    return pipeline.compile_plan(config)
+
+def retouch_image_aggressive(pil_image, denoiser=RETOUCH_AGAIN_DENOISER, cache=None):
+    """Stronger retouch used by the 'Retouch Again' button"""
+    return aggressive_plan(denoiser).run(pil_image, timer=stage_timer, cache=cache)
+
+# --- Tuning ---
+# Settings of the "Tune" view; the defaults reproduce the 'Retouch Again' preset
+TUNING_DEFAULTS = {"brightness": 1.0, "contrast": 1.0, "sharpen": 2.0, "denoise": RETOUCH_AGAIN_DENOISER}
+
+@functools.lru_cache(maxsize=256)
+def tuning_plan(brightness, contrast, sharpen, denoise, denoise_budget=None):
+    """The 'Retouch Again' pipeline with adjusted strengths.
+
+    Stages left at their neutral value are dropped, so untouched settings
+    share stage-cache entries with the preset. Brightness and contrast come
+    after the stretch, which would otherwise undo them.
+    """
+    config = [dict(AGGRESSIVE_PIPELINE[0])]
+    if denoise != "off":
+        spec = {"stage": "denoise", "method": denoise}
+        if denoise_budget is not None:
+            spec["budget"] = denoise_budget
+        config.append(spec)
+    if sharpen != 1.0:
+        config.append({"stage": "sharpen", "factor": sharpen})
+    config.append({"stage": "stretch"})
+    if brightness != 1.0:
+        config.append({"stage": "brightness", "factor": brightness})
+    if contrast != 1.0:
+        config.append({"stage": "contrast", "factor": contrast})
+    return pipeline.compile_plan(config)
+
+def make_proxy(image, max_edge):
+    """Area-downscaled copy of an image whose long edge is at most max_edge"""
+    scale = max_edge / max(image.width, image.height)
+    if scale >= 1:
+        return image.convert("RGB")
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    rgb = np.asarray(image.convert("RGB") if image.mode != "RGB" else image)
+    return Image.fromarray(cv2.resize(rgb, size, interpolation=cv2.INTER_AREA))
+
+@timed_stage("tuning_preview", size=lambda args, result: len(result))
+def render_tuning_preview(session, index, settings):
+    """Retouch the image's proxy with the given settings and return it as JPEG bytes"""
+    plan = tuning_plan(**settings, denoise_budget=TUNING_PREVIEW_BUDGET)
+    preview = plan.run(session.tuning_proxy(index), timer=stage_timer, cache=session.stage_cache_for(("proxy", index)))
+    buffer = io.BytesIO()
+    preview.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+@timed_stage("tuned_variant")
+def tuned_variant(pil_image, settings, cache=None, channel_plan=None):
+    """Return (retouched, watermarked) at full resolution for confirmed tuning settings"""
+    retouched = tuning_plan(**settings).run(pil_image, timer=stage_timer, cache=cache)
+    return retouched, watermark_with(channel_plan, retouched)
 
-    cv_image = cv2.convertScaleAbs(cv_image, alpha=alpha, beta=beta)
+# --- Tiled Processing ---
+@timed_stage("tiled_retouch")
+def retouch_image_tiled(pil_image, tile_rows=TILE_ROWS, plan=None):
+    """Same output as retouch_image, computed in horizontal strips.
 
-    # Back to PIL
-    processed_image = Image.fromarray(cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB))
+    Global statistics are gathered in streaming passes, so besides the input and
+    the output only one strip (plus overlap for spatial stages) is held in memory.
+    """
+    return split_plan(plan or DEFAULT_PLAN)[0].run_tiled(pil_image, tile_rows, timer=stage_timer)
 
-    # Sharpen
-    enhancer = ImageEnhance.Sharpness(processed_image)
-    processed_image = enhancer.enhance(1.3)
+# --- Retouch Result Cache ---
+class RetouchCache:
+    """Content-addressed on-disk cache of retouched (non-watermarked) images with LRU eviction"""
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.total_bytes = None
+        self.lock = threading.Lock()
 
-    # Component stretch
-    processed_image = component_stretching(processed_image)
+    def enabled(self):
+        return self.max_bytes > 0
 
-    return processed_image
+    def make_key(self, image_bytes, params):
+        """Hash the raw upload bytes together with the pipeline parameters and code version"""
+        digest = hashlib.sha256()
+        digest.update(image_bytes)
+        digest.update(repr(sorted(params.items())).encode("utf-8"))
+        digest.update(PIPELINE_VERSION.encode("utf-8"))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.png")
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            # Touch the entry so it becomes the most recently used one
+            os.utime(path)
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            CACHE_LOOKUPS.inc(result="miss")
+            return None
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.load()
+        except Exception as e:
+            print(f"Discarding unreadable cache entry {path}: {e}")
+            with self.lock:
+                self.misses += 1
+            CACHE_LOOKUPS.inc(result="miss")
+            return None
+
+        with self.lock:
+            self.hits += 1
+        CACHE_LOOKUPS.inc(result="hit")
+        return image.convert("RGB") if image.mode != "RGB" else image
+
+    def put(self, key, image):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial entry
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", compress_level=1)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(buffer.getvalue())
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            if self.total_bytes is None:
+                self.total_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self.total_bytes += buffer.tell()
+            if self.total_bytes > self.max_bytes:
+                self._evict()
 
+    def _evict(self):
+        """Remove least recently used entries until the cache fits in its size cap"""
+        entries = sorted(self._entries())
+        self.total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.total_bytes -= size
+            except FileNotFoundError:
+                pass
+
+    def log_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups if lookups else 0.0
+        print(f"Retouch cache: {self.hits} hits, {self.misses} misses ({hit_rate:.0%} hit rate)")
+
+retouch_cache = RetouchCache(RETOUCH_CACHE_DIR, RETOUCH_CACHE_MAX_MB * 1024 * 1024)
+
+def cached_retouch(image_bytes, image, params=None, plan=None, stage_cache=None):
+    """Return retouch_image(image, plan), reusing the cached result for identical uploads"""
+    plan = plan or DEFAULT_PLAN
+    if not retouch_cache.enabled():
+        return retouch_image(image, plan, stage_cache)
+
+    key = retouch_cache.make_key(image_bytes, params or {"pipeline": plan.signature})
+    cached = retouch_cache.get(key)
+    if cached is not None:
+        return cached
+
+    retouched = retouch_image(image, plan, stage_cache)
+    try:
+        retouch_cache.put(key, retouched)
+    except Exception as e:
+        print(f"Error writing retouch cache entry: {e}")
+    return retouched
+
+# --- Auto QC ---
+# A metric at or beyond these values scores 0 (clipping uses AUTO_QC_MAX_CLIPPED)
+AUTO_QC_MAX_CAST = 0.08           # largest channel mean deviation, relative to the mean
+AUTO_QC_MIN_SHARPNESS = 60.0      # Laplacian variance on the proxy at which sharpness scores 1
+AUTO_QC_EXPOSURE_MARGIN = 48      # mean gray level this far from mid-gray is still fine...
+AUTO_QC_EXPOSURE_FALLOFF = 64     # ...and scores 0 this much further out
+
+@timed_stage("auto_qc")
+def score_retouch(image):
+    """Quality metrics of a retouched image, measured on a small proxy.
+
+    Each metric is mapped to a 0..1 score; the confidence is the lowest of
+    them, so one bad metric is enough to send the image to a reviewer.
+    """
+    rgb = np.asarray(make_proxy(image, AUTO_QC_PROXY_EDGE))
+    gray = cv2.cvtColor(rgb, cv2.COLOR_RGB2GRAY)
+    hist = cv2.calcHist([gray], [0], None, [256], [0, 256]).ravel()
+    pixels = max(gray.size, 1)
+
+    brightness = float(hist @ np.arange(256)) / pixels
+    clipped = float(hist[:3].sum() + hist[253:].sum()) / pixels
+    # Cast left over after gray world: how far the channel means still drift apart
+    means = cv2.mean(rgb)[:3]
+    average = sum(means) / 3
+    cast = max(abs(m - average) for m in means) / max(average, 1)
+    sharpness = float(cv2.Laplacian(gray, cv2.CV_32F).var())
+
+    scores = {
+        "exposure": 1 - min(max(abs(brightness - 128) - AUTO_QC_EXPOSURE_MARGIN, 0) / AUTO_QC_EXPOSURE_FALLOFF, 1),
+        "clipping": 1 - min(clipped / AUTO_QC_MAX_CLIPPED, 1) if AUTO_QC_MAX_CLIPPED > 0 else 1.0,
+        "cast": 1 - min(cast / AUTO_QC_MAX_CAST, 1),
+        "sharpness": min(sharpness / AUTO_QC_MIN_SHARPNESS, 1),
+    }
+    scores = {name: float(value) for name, value in scores.items()}
+    return {
+        "confidence": min(scores.values()),
+        "scores": scores,
+        "brightness": brightness,
+        "clipped": clipped,
+        "cast": cast,
+        "sharpness": sharpness,
+    }
+
+def describe_auto_qc(score):
+    weakest = min(score["scores"], key=score["scores"].get)
+    return f"confidence {score['confidence']:.2f}, weakest: {weakest}"
+
+# --- Duplicate Detection ---
+@timed_stage("perceptual_hash")
+def perceptual_hash(image):
+    """Compute a 64-bit difference hash (dHash) of an image"""
+    # Shrink first so the grayscale conversion only touches 72 pixels
+    small = image.resize((9, 8), Image.BILINEAR, reducing_gap=2.0).convert("L")
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = pixels[:, 1:] > pixels[:, :-1]
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def hamming_distance(hash_a, hash_b):
+    return bin(hash_a ^ hash_b).count("1")
+
+def group_near_duplicates(hashes, max_distance=PHASH_MAX_DISTANCE):
+    """Return, for each hash, the index of the earlier image it duplicates (or None)"""
+    duplicate_of = []
+    for i, phash in enumerate(hashes):
+        match = None
+        for j in range(i):
+            # Only compare against group representatives
+            if duplicate_of[j] is None and hamming_distance(phash, hashes[j]) <= max_distance:
+                match = j
+                break
+        duplicate_of.append(match)
+    return duplicate_of
+
+class PerceptualHashIndex:
+    """Local JSON index of perceptual hashes from recently processed supply IDs"""
+    def __init__(self, path, max_supplies):
+        self.path = path
+        self.max_supplies = max_supplies
+        self.lock = threading.Lock()
+        self.supplies = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            print(f"Error loading perceptual hash index {self.path}: {e}")
+            return {}
+
+    def _save(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.supplies, f)
+        os.replace(tmp_path, self.path)
+
+    def find(self, phash, max_distance=PHASH_MAX_DISTANCE, exclude=None):
+        """Return (supply_id, distance) of the closest indexed image outside supply exclude, or None"""
+        best = None
+        with self.lock:
+            for supply_id, entry in self.supplies.items():
+                if supply_id == exclude:
+                    continue
+                for stored in entry["hashes"]:
+                    distance = hamming_distance(phash, int(stored, 16))
+                    if distance <= max_distance and (best is None or distance < best[1]):
+                        best = (supply_id, distance)
+        return best
+
+    def add(self, supply_id, hashes):
+        with self.lock:
+            self.supplies.pop(supply_id, None)
+            self.supplies[supply_id] = {
+                "time": time.time(),
+                "hashes": [f"{phash:016x}" for phash in hashes]
+            }
+            # Keep only the most recent supplies (dicts preserve insertion order)
+            while len(self.supplies) > self.max_supplies:
+                del self.supplies[next(iter(self.supplies))]
+            try:
+                self._save()
+            except Exception as e:
+                print(f"Error saving perceptual hash index: {e}")
+
+phash_index = PerceptualHashIndex(PHASH_INDEX_PATH, PHASH_INDEX_SUPPLIES)
+
+@timed_stage("watermark")
 def add_watermark(image, watermark_path=WATERMARK_PATH, position="top-right", margin=5, opacity=0.8):
     try:
         # Check if watermark file exists
@@ -197,19 +893,78 @@ def add_watermark(image, watermark_path=WATERMARK_PATH, position="top-right", ma
         print(f"Error applying watermark: {e}")
         return image.convert("RGB") if image.mode != "RGB" else image
 
+# --- Pipeline Plans ---
+pipeline.register_stage("watermark", "image")(add_watermark)
+
+def load_pipeline_plans(path):
+    """Compile the default plan and the per-channel plans of a PIPELINE_CONFIG file.
+
+    The file holds {"default": <stages>, "channels": {"<channel id>": <stages>}},
+    where <stages> is a preset name from pipeline.PRESETS or a list of stage specs.
+    """
+    default = pipeline.PRESETS["linear" if LINEAR_LIGHT else "default"]
+    channels = {}
+    if path:
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        default = pipeline.load_config(config.get("default", default))
+        channels = {
+            int(channel_id): pipeline.load_config(stages)
+            for channel_id, stages in config.get("channels", {}).items()
+        }
+    default_plan = pipeline.compile_plan(default)
+    channel_plans = {channel_id: pipeline.compile_plan(stages) for channel_id, stages in channels.items()}
+    if path:
+        print(f"Retouch pipeline: {default_plan.describe()}")
+        for channel_id, plan in channel_plans.items():
+            print(f"Retouch pipeline for channel {channel_id}: {plan.describe()}")
+    return default_plan, channel_plans
+
+DEFAULT_PLAN, CHANNEL_PLANS = load_pipeline_plans(PIPELINE_CONFIG)
+
+@functools.lru_cache(maxsize=None)
+def split_plan(plan):
+    """(retouch plan, watermark plan or None) of a configured plan.
+
+    Image stages at the end of a plan (e.g. "watermark" with its own position)
+    make the delivered copy, so they stay out of the non-watermarked retouch.
+    """
+    return plan.split_image_stages()
+
+def watermark_with(plan, retouched):
+    """Watermarked copy of a retouch: the plan's image stages if it has any, else add_watermark"""
+    finish = split_plan(plan or DEFAULT_PLAN)[1]
+    return finish.run(retouched) if finish is not None else add_watermark(retouched)
+
+def plan_for_channel(channel_id):
+    return CHANNEL_PLANS.get(channel_id, DEFAULT_PLAN)
+
 # --- Google Drive Functions ---
+# Optional factory returning an httplib2-compatible transport for the Drive client.
+# load_test.py sets it to route Drive calls to an in-process stand-in server.
+drive_http_factory = None
+
 def is_gdrive_enabled():
     """Check if Google Drive functionality is properly configured"""
+    if drive_http_factory is not None:
+        return True
     return CREDENTIALS_FILE is not None and os.path.exists(CREDENTIALS_FILE)
 
+def get_drive_service():
+    """Build a Drive v3 client from the service account (or the injected transport)"""
+    if drive_http_factory is not None:
+        return build('drive', 'v3', http=drive_http_factory(), static_discovery=True)
+    creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
+    return build('drive', 'v3', credentials=creds)
+
+@timed_io("drive_create_folder")
 def create_drive_folder(folder_name, parent_id=None):
     if not is_gdrive_enabled():
         print("Cannot create Google Drive folder: credentials not configured")
         return None, None
     
     try:
-        creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-        service = build('drive', 'v3', credentials=creds)
+        service = get_drive_service()
         folder_metadata = {
             'name': folder_name,
             'mimeType': 'application/vnd.google-apps.folder'
@@ -229,14 +984,14 @@ def create_drive_folder(folder_name, parent_id=None):
         print(f'Error creating folder: {error}')
         return None, None
 
+@timed_io("drive_upload", size=lambda args, result: len(args[0]))
 def upload_to_google_drive(image_data, filename='processed_image.png', folder_id=None):
     if not is_gdrive_enabled():
         print("Cannot upload to Google Drive: credentials not configured")
         return None, None
     
     try:
-        creds = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=SCOPES)
-        service = build('drive', 'v3', credentials=creds)
+        service = get_drive_service()
         file_metadata = {'name': filename}
         if folder_id:
             file_metadata['parents'] = [folder_id]
@@ -248,6 +1003,7 @@ def upload_to_google_drive(image_data, filename='processed_image.png', folder_id
             media_body=media,
             fields='id, webViewLink'
         ).execute()
+        IO_BYTES.inc(len(image_data), operation="drive_upload")
 
         # Make file public
         service.permissions().create(
@@ -261,12 +1017,240 @@ def upload_to_google_drive(image_data, filename='processed_image.png', folder_id
         print(f'An error occurred during upload: {error}')
         return None, None
 
+# --- Job Scheduler ---
+PRIORITY_INTERACTIVE = 0  # previews and Retouch Again
+PRIORITY_BULK = 1         # ingest of new attachments
+PRIORITY_BACKGROUND = 2   # Drive uploads and local saves
+PRIORITY_SPECULATIVE = 3  # precomputed Retouch Again variants
+
+PRIORITY_NAMES = {
+    PRIORITY_INTERACTIVE: "interactive",
+    PRIORITY_BULK: "bulk",
+    PRIORITY_BACKGROUND: "background",
+    PRIORITY_SPECULATIVE: "speculative",
+}
+
+class QueueFullError(Exception):
+    """Raised when the scheduler queue is at its depth limit"""
+
+class Job:
+    def __init__(self, fn, args, future):
+        self.fn = fn
+        self.args = args
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+        # Run with the submitter's context so trace spans land in the right session
+        self.context = contextvars.copy_context()
+
+class JobScheduler:
+    """Runs blocking work on a thread pool in priority order with per-user fair queuing"""
+    def __init__(self, workers, max_queue):
+        self.workers = max(workers, 1)
+        self.max_queue = max_queue
+        # Per priority: user_id -> deque of jobs, rotated round-robin between users
+        self.queues = {priority: collections.OrderedDict() for priority in PRIORITY_NAMES}
+        # future -> (priority, user_id, job) while the job is still waiting for a worker
+        self.queued = {}
+        self.depth = {priority: 0 for priority in PRIORITY_NAMES}
+        self.running = {priority: 0 for priority in PRIORITY_NAMES}
+        # Low-value work never occupies more than this many workers at once
+        self.max_running = {PRIORITY_SPECULATIVE: 1, PRIORITY_BACKGROUND: max(self.workers // 2, 1)}
+        self.stats = {
+            priority: {"submitted": 0, "started": 0, "completed": 0, "rejected": 0, "wait_total": 0.0, "wait_max": 0.0}
+            for priority in PRIORITY_NAMES
+        }
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job")
+        self.condition = None
+        self.worker_tasks = []
+
+    def _ensure_started(self):
+        if self.condition is None:
+            self.condition = asyncio.Condition()
+            self.worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def total_depth(self):
+        return sum(self.depth.values())
+
+    def is_full(self):
+        return self.total_depth() >= self.max_queue
+
+    def submit(self, priority, user_id, fn, *args):
+        """Queue fn(*args) and return an asyncio future for its result.
+
+        Interactive jobs are never rejected; other classes raise QueueFullError
+        once the queue holds max_queue jobs.
+        """
+        self._ensure_started()
+        if priority != PRIORITY_INTERACTIVE and self.is_full():
+            self.stats[priority]["rejected"] += 1
+            raise QueueFullError(f"{self.total_depth()} jobs waiting")
+
+        future = asyncio.get_running_loop().create_future()
+        job = Job(fn, args, future)
+        self.queues[priority].setdefault(user_id, collections.deque()).append(job)
+        self.queued[future] = (priority, user_id, job)
+        self.depth[priority] += 1
+        self.stats[priority]["submitted"] += 1
+        self._notify()
+        return future
+
+    def promote(self, future, priority, user_id):
+        """Move a job that is still waiting to a more urgent priority class (and to user_id's queue).
+
+        Returns False when the job has already started or finished.
+        """
+        entry = self.queued.get(future)
+        if entry is None:
+            return False
+        old_priority, old_user_id, job = entry
+        if priority >= old_priority:
+            return True
+        jobs = self.queues[old_priority][old_user_id]
+        jobs.remove(job)
+        if not jobs:
+            del self.queues[old_priority][old_user_id]
+        self.depth[old_priority] -= 1
+        self.queues[priority].setdefault(user_id, collections.deque()).append(job)
+        self.queued[future] = (priority, user_id, job)
+        self.depth[priority] += 1
+        self._notify()
+        return True
+
+    async def run(self, priority, user_id, fn, *args):
+        return await self.submit(priority, user_id, fn, *args)
+
+    async def wait_for_capacity(self):
+        self._ensure_started()
+        async with self.condition:
+            await self.condition.wait_for(lambda: not self.is_full())
+
+    def _notify(self):
+        async def notify():
+            async with self.condition:
+                self.condition.notify_all()
+        asyncio.get_running_loop().create_task(notify())
+
+    def _pop_job(self):
+        for priority, users in self.queues.items():
+            if not users or self.running[priority] >= self.max_running.get(priority, self.workers):
+                continue
+            user_id, jobs = next(iter(users.items()))
+            job = jobs.popleft()
+            if jobs:
+                # Move this user to the back so other users get the next turn
+                users.move_to_end(user_id)
+            else:
+                del users[user_id]
+            self.depth[priority] -= 1
+            self.queued.pop(job.future, None)
+            return priority, job
+        return None
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            async with self.condition:
+                await self.condition.wait_for(lambda: self._has_runnable_job())
+                priority, job = self._pop_job()
+                self.running[priority] += 1
+                # Queue space freed up for anyone waiting on capacity
+                self.condition.notify_all()
+
+            try:
+                if job.future.cancelled():
+                    continue
+                wait = time.perf_counter() - job.enqueued_at
+                stats = self.stats[priority]
+                stats["started"] += 1
+                stats["wait_total"] += wait
+                stats["wait_max"] = max(stats["wait_max"], wait)
+                JOB_WAIT_SECONDS.observe(wait, priority=PRIORITY_NAMES[priority])
+                try:
+                    result = await loop.run_in_executor(self.executor, job.context.run, job.fn, *job.args)
+                except Exception as e:
+                    if not job.future.done():
+                        job.future.set_exception(e)
+                else:
+                    if not job.future.done():
+                        job.future.set_result(result)
+                stats["completed"] += 1
+            finally:
+                async with self.condition:
+                    self.running[priority] -= 1
+                    self.condition.notify_all()
+
+    def _has_runnable_job(self):
+        return any(
+            users and self.running[priority] < self.max_running.get(priority, self.workers)
+            for priority, users in self.queues.items()
+        )
+
+    def metrics(self):
+        """Queue depth, running jobs and wait times per priority class"""
+        result = {}
+        for priority, name in PRIORITY_NAMES.items():
+            stats = self.stats[priority]
+            result[name] = {
+                "depth": self.depth[priority],
+                "running": self.running[priority],
+                "submitted": stats["submitted"],
+                "completed": stats["completed"],
+                "rejected": stats["rejected"],
+                "wait_avg": stats["wait_total"] / stats["started"] if stats["started"] else 0.0,
+                "wait_max": stats["wait_max"],
+            }
+        return result
+
+scheduler = JobScheduler(SCHEDULER_WORKERS, SCHEDULER_MAX_QUEUE)
+
+async def submit_with_backpressure(priority, user_id, fn, *args, notify=None):
+    """Submit a job, waiting for queue space (and telling the user once) while the queue is full"""
+    notified = False
+    while True:
+        try:
+            return scheduler.submit(priority, user_id, fn, *args)
+        except QueueFullError:
+            if notify is not None and not notified:
+                notified = True
+                await notify(
+                    f"⏳ The processing queue is full ({scheduler.total_depth()} jobs waiting). "
+                    f"Your images will start as soon as there is room."
+                )
+            await scheduler.wait_for_capacity()
+
+async def run_with_backpressure(priority, user_id, fn, *args, notify=None):
+    """Run a job that must not be dropped, waiting for queue space first if the queue is full"""
+    job = await submit_with_backpressure(priority, user_id, fn, *args, notify=notify)
+    return await job
+
 # --- UI Components ---
-class QCButtons(ui.View):
+class SessionTracedMixin:
+    """Attributes the work done for an interaction to self.session's trace (mix in before ui.View / ui.Modal)"""
+
+    async def interaction_check(self, interaction: discord.Interaction):
+        tracing.current_trace.set(self.session.trace)
+        return True
+
+# Discord's limit on the options of one select menu
+MAX_SELECT_OPTIONS = 25
+
+def join_numbers(numbers):
+    """'1', '1 and 2' or '1, 2, and 3'"""
+    if len(numbers) <= 2:
+        return " and ".join(numbers)
+    return ", ".join(numbers[:-1]) + ", and " + numbers[-1]
+
+class QCButtons(SessionTracedMixin, ui.View):
     def __init__(self, session):
         super().__init__(timeout=None)
         self.session = session
-    
+        # Discord allows 25 options per select, so offer the next 25 pending images
+        pending = session.pending_indices()[:MAX_SELECT_OPTIONS]
+        if pending:
+            self.add_item(PassSelect(session, pending))
+        if session.contact_sheet:
+            self.contact_sheet_button.label = "🖼️ Single image"
+
     @ui.button(label="◀ Previous", style=ButtonStyle.secondary)
     async def previous_button(self, interaction: discord.Interaction, button: ui.Button):
         if self.session.current_index > 0:
@@ -289,6 +1273,7 @@ class QCButtons(ui.View):
         await interaction.response.send_message("QC process cancelled.", ephemeral=False)
         
         # Delete session
+        self.session.close()
         if self.session.message_id in active_sessions:
             del active_sessions[self.session.message_id]
             
@@ -299,6 +1284,12 @@ class QCButtons(ui.View):
     async def not_pass_button(self, interaction: discord.Interaction, button: ui.Button):
         # Mark current image as not passed
         self.session.qc_status[self.session.current_index] = False
+        self.session.auto_passed.discard(self.session.current_index)
+        if self.session.current_index in self.session.passed_images:
+            self.session.passed_images.remove(self.session.current_index)
+
+        # Reviewers almost always retouch failed images again, so start on it now
+        self.session.start_speculative_retouch(self.session.current_index)
         
         # Ask for feedback
         feedback_modal = FeedbackModal(self.session)
@@ -308,88 +1299,119 @@ class QCButtons(ui.View):
     
     @ui.button(label="✅ Pass QC", style=ButtonStyle.success)
     async def pass_button(self, interaction: discord.Interaction, button: ui.Button):
-        # Mark current image as passed
-        self.session.qc_status[self.session.current_index] = True
-        
-        # Add to passed images list
-        if self.session.current_index not in self.session.passed_images:
-            self.session.passed_images.append(self.session.current_index)
+        # Mark current image as passed (a reviewer confirming an auto-pass makes it a manual pass)
+        self.session.mark_passed(self.session.current_index)
         
         # Format the passed images message
         passed_nums = [str(i+1) for i in self.session.passed_images]
-        if len(passed_nums) <= 2:
-            passed_str = " and ".join(passed_nums)
-        else:
-            passed_str = ", ".join(passed_nums[:-1]) + ", and " + passed_nums[-1]
-        
         await interaction.response.send_message(
-            f"Image{' ' if len(passed_nums) == 1 else 's '}{passed_str} marked as PASSED.", 
+            f"Image{' ' if len(passed_nums) == 1 else 's '}{join_numbers(passed_nums)} marked as PASSED.", 
             ephemeral=False
         )
         
-        # Move to next image if available
-        if self.session.current_index < len(self.session.processed_images) - 1:
-            self.session.current_index += 1
+        # Move to the next image that still needs a reviewer, if any
+        next_index = self.session.next_index_for_review(self.session.current_index)
+        if next_index is not None:
+            self.session.current_index = next_index
             await update_qc_message(interaction, self.session)
         else:
             # Check if all images have been reviewed
             if self.session.is_complete():
                 await finalize_qc_process(interaction, self.session)
 
-class RetouchAgainButton(ui.View):
+    @ui.button(label="🗂️ Contact sheet", style=ButtonStyle.secondary, row=1)
+    async def contact_sheet_button(self, interaction: discord.Interaction, button: ui.Button):
+        # Switch between the current image and a grid of the whole supply
+        self.session.contact_sheet = not self.session.contact_sheet
+        await update_qc_message(interaction, self.session)
+
+    @ui.button(label="✅ Pass all remaining", style=ButtonStyle.success, row=1)
+    async def pass_all_button(self, interaction: discord.Interaction, button: ui.Button):
+        pending = self.session.pending_indices()
+        if not pending:
+            await interaction.response.send_message("No images are waiting for review.", ephemeral=True)
+            # Auto-QC may have decided the rest, in which case this click is what ends the session
+            if self.session.is_complete():
+                await finalize_qc_process(interaction, self.session)
+            return
+        await self.pass_images(interaction, pending)
+
+    async def pass_images(self, interaction, indices):
+        """Pass several images with one status update, then finalize or show the next pending image once"""
+        with tracing.span("bulk_pass", images=len(indices)):
+            for index in indices:
+                self.session.mark_passed(index)
+
+            numbers = [str(i + 1) for i in sorted(indices)]
+            await interaction.response.send_message(
+                f"Image{' ' if len(numbers) == 1 else 's '}{join_numbers(numbers)} marked as PASSED.",
+                ephemeral=False
+            )
+
+            if self.session.is_complete():
+                await finalize_qc_process(interaction, self.session)
+                return
+            pending = self.session.pending_indices()
+            if self.session.current_index not in pending:
+                self.session.current_index = pending[0]
+            await update_qc_message(interaction, self.session)
+
+class PassSelect(ui.Select):
+    """Multi-select of images waiting for review, passed together"""
+
+    def __init__(self, session, indices):
+        options = []
+        for index in indices:
+            score = session.auto_qc.get(index)
+            options.append(discord.SelectOption(
+                label=f"Image {index + 1}", value=str(index),
+                description=f"Auto-QC {describe_auto_qc(score)}" if score is not None else None
+            ))
+        super().__init__(
+            placeholder="✅ Pass selected images...", min_values=1, max_values=len(options), options=options, row=2
+        )
+
+    async def callback(self, interaction: discord.Interaction):
+        await self.view.pass_images(interaction, [int(value) for value in self.values])
+
+class RetouchAgainButton(SessionTracedMixin, ui.View):
     def __init__(self, session, image_index):
         super().__init__(timeout=None)
         self.session = session
         self.image_index = image_index
-    
+
     @ui.button(label="🔄 Retouch Again", style=ButtonStyle.primary)
     async def retouch_button(self, interaction: discord.Interaction, button: ui.Button):
+        with tracing.span("retouch_again", index=self.image_index):
+            await self._retouch(interaction)
+
+    async def _retouch(self, interaction):
         await interaction.response.send_message(f"Retouching image {self.image_index + 1} again...", ephemeral=False)
         
         # Get the original image
         original_image = self.session.original_images[self.image_index]
         
-        # Apply more aggressive retouching
-        # This time we'll apply a stronger adjustment
+        # Apply more aggressive retouching off the event loop so other reviewers aren't blocked
         try:
-            cv_image = cv2.cvtColor(np.array(original_image), cv2.COLOR_RGB2BGR)
-            
-            # Apply stronger adjustments
-            alpha = 1.3  # Higher contrast
-            beta = 15    # Higher brightness
-            cv_image = cv2.convertScaleAbs(cv_image, alpha=alpha, beta=beta)
-            
-            # Apply additional noise reduction
-            cv_image = cv2.fastNlMeansDenoisingColored(cv_image, None, 10, 10, 7, 21)
-            
-            # Convert back to PIL
-            retouched = Image.fromarray(cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB))
-            
-            # Apply stronger sharpening
-            enhancer = ImageEnhance.Sharpness(retouched)
-            retouched = enhancer.enhance(2.0)
-            
-            # Apply component stretching
-            retouched = component_stretching(retouched)
-            
-            # Save the retouched image without watermark
-            self.session.processed_images_no_watermark[self.image_index] = retouched
-            
-            # Apply watermark
-            watermarked = add_watermark(retouched)
-            
-            # Replace the processed image
-            self.session.processed_images[self.image_index] = watermarked
-            
-            # Reset QC status for this image
-            self.session.qc_status[self.image_index] = None
-            
-            # If this image was in passed_images, remove it
-            if self.image_index in self.session.passed_images:
-                self.session.passed_images.remove(self.image_index)
+            retouched = None
+            speculative = self.session.take_speculative_retouch(self.image_index)
+            if speculative is not None and not speculative.cancelled():
+                # A speculative job still waiting behind bulk work is moved up to run as this click
+                scheduler.promote(speculative, PRIORITY_INTERACTIVE, interaction.user.id)
+                try:
+                    retouched, watermarked = await speculative
+                except Exception as e:
+                    print(f"Speculative retouch failed, retrying: {e}")
+
+            if retouched is None:
+                # Statistics and unchanged stages come from the session's stage cache
+                retouched, watermarked = await scheduler.run(
+                    PRIORITY_INTERACTIVE, interaction.user.id, aggressive_variant, original_image,
+                    self.session.stage_cache_for(self.image_index), self.session.plan
+                )
             
-            # Set current index to this image
-            self.session.current_index = self.image_index
+            # Replace the processed image and put it back up for review
+            self.session.replace_retouch(self.image_index, retouched, watermarked)
             
             # Update the QC message
             await update_qc_message(interaction, self.session)
@@ -397,7 +1419,111 @@ class RetouchAgainButton(ui.View):
         except Exception as e:
             await interaction.channel.send(f"❌ Error retouching image: {str(e)}")
 
-class FeedbackModal(ui.Modal, title="Image Feedback"):
+    @ui.button(label="🎛️ Tune", style=ButtonStyle.secondary)
+    async def tune_button(self, interaction: discord.Interaction, button: ui.Button):
+        with tracing.span("tune", index=self.image_index):
+            # The first preview also builds the proxy, which may take a moment for large photos
+            await interaction.response.defer(thinking=True)
+            view = TuningView(self.session, self.image_index)
+            try:
+                file = await view.render_preview(interaction.user.id)
+            except Exception as e:
+                await interaction.followup.send(f"❌ Error rendering preview: {str(e)}")
+                return
+            await interaction.followup.send(content=view.describe(), file=file, view=view)
+
+# Choices offered by the tuning view's select menus: (setting, placeholder, [(label, value)])
+TUNING_CHOICES = [
+    ("brightness", "Brightness", [("-20%", 0.8), ("-10%", 0.9), ("Unchanged", 1.0), ("+10%", 1.1), ("+20%", 1.2), ("+30%", 1.3)]),
+    ("contrast", "Contrast", [("-20%", 0.8), ("-10%", 0.9), ("Unchanged", 1.0), ("+10%", 1.1), ("+20%", 1.2), ("+30%", 1.3)]),
+    ("sharpen", "Sharpen", [("Off", 1.0), ("Light", 1.3), ("Medium", 1.6), ("Strong", 2.0), ("Very strong", 2.5), ("Maximum", 3.0)]),
+    ("denoise", "Denoise", [("Off", "off"), ("Bilateral (fast)", "bilateral"), ("Edge-preserving", "edge_preserving"),
+                            ("NL-means", "nlmeans_guided")]),
+]
+
+class TuningSelect(ui.Select):
+    def __init__(self, setting, placeholder, choices, current, row):
+        self.setting = setting
+        self.values_by_key = {str(value): value for _, value in choices}
+        options = [
+            discord.SelectOption(label=f"{placeholder}: {label}", value=str(value), default=value == current)
+            for label, value in choices
+        ]
+        super().__init__(placeholder=placeholder, options=options, row=row)
+
+    async def callback(self, interaction: discord.Interaction):
+        selected = self.values[0]
+        for option in self.options:
+            option.default = option.value == selected
+        await self.view.update_setting(interaction, self.setting, self.values_by_key[selected])
+
+class TuningView(SessionTracedMixin, ui.View):
+    """Select menus adjusting the retouch strength, previewed live on a low-resolution proxy.
+
+    Every change re-renders only the proxy (unchanged stages come from the
+    session's stage cache); the full-resolution image is retouched once, when
+    the reviewer applies the settings.
+    """
+
+    def __init__(self, session, image_index, settings=None):
+        super().__init__(timeout=None)
+        self.session = session
+        self.image_index = image_index
+        self.settings = dict(settings or TUNING_DEFAULTS)
+        self.generation = 0
+        for row, (setting, placeholder, choices) in enumerate(TUNING_CHOICES):
+            self.add_item(TuningSelect(setting, placeholder, choices, self.settings[setting], row))
+
+    def describe(self):
+        s = self.settings
+        return (
+            f"Tuning image {self.image_index + 1} (low-resolution preview): brightness ×{s['brightness']:g}, "
+            f"contrast ×{s['contrast']:g}, sharpen {s['sharpen']:g}, denoise {s['denoise']}"
+        )
+
+    async def render_preview(self, user_id):
+        jpeg = await scheduler.run(
+            PRIORITY_INTERACTIVE, user_id, render_tuning_preview, self.session, self.image_index, dict(self.settings)
+        )
+        return File(io.BytesIO(jpeg), filename="tuning_preview.jpg")
+
+    async def update_setting(self, interaction, setting, value):
+        self.settings[setting] = value
+        self.generation += 1
+        generation = self.generation
+        await interaction.response.defer()
+        with tracing.span("tuning_preview", index=self.image_index, setting=setting):
+            try:
+                file = await self.render_preview(interaction.user.id)
+            except Exception as e:
+                await interaction.followup.send(f"❌ Error rendering preview: {str(e)}", ephemeral=True)
+                return
+            # A newer change is already rendering; only the latest preview is shown
+            if generation != self.generation:
+                return
+            start = time.perf_counter()
+            await interaction.message.edit(content=self.describe(), attachments=[file], view=self)
+            observe_io("discord_upload", start)
+
+    @ui.button(label="✅ Apply at full resolution", style=ButtonStyle.success, row=4)
+    async def apply_button(self, interaction: discord.Interaction, button: ui.Button):
+        with tracing.span("tuned_retouch", index=self.image_index):
+            await interaction.response.send_message(
+                f"Retouching image {self.image_index + 1} at full resolution...", ephemeral=False
+            )
+            self.stop()
+            try:
+                retouched, watermarked = await scheduler.run(
+                    PRIORITY_INTERACTIVE, interaction.user.id, tuned_variant,
+                    self.session.original_images[self.image_index], dict(self.settings),
+                    self.session.stage_cache_for(self.image_index), self.session.plan
+                )
+                self.session.replace_retouch(self.image_index, retouched, watermarked)
+                await update_qc_message(interaction, self.session)
+            except Exception as e:
+                await interaction.channel.send(f"❌ Error retouching image: {str(e)}")
+
+class FeedbackModal(SessionTracedMixin, ui.Modal, title="Image Feedback"):
     feedback = ui.TextInput(
         label="What needs improvement?",
         placeholder="Describe what needs to be fixed in this image...",
@@ -409,7 +1535,7 @@ class FeedbackModal(ui.Modal, title="Image Feedback"):
     def __init__(self, session):
         super().__init__()
         self.session = session
-    
+
     async def on_submit(self, interaction: discord.Interaction):
         # Save the feedback
         current_index = self.session.current_index
@@ -417,6 +1543,7 @@ class FeedbackModal(ui.Modal, title="Image Feedback"):
         
         # Mark current image as not passed
         self.session.qc_status[current_index] = False
+        self.session.start_speculative_retouch(current_index)
         
         await interaction.response.send_message(
             f"Image {current_index + 1} marked as NOT PASSED.\nFeedback: {self.feedback.value if self.feedback.value else 'None provided'}", 
@@ -424,9 +1551,10 @@ class FeedbackModal(ui.Modal, title="Image Feedback"):
             view=RetouchAgainButton(self.session, current_index)
         )
         
-        # Move to next image if available
-        if current_index < len(self.session.processed_images) - 1:
-            self.session.current_index += 1
+        # Move to the next image that still needs a reviewer, if any
+        next_index = self.session.next_index_for_review(current_index)
+        if next_index is not None:
+            self.session.current_index = next_index
             await update_qc_message(interaction, self.session)
         else:
             # Check if all images have been reviewed
@@ -434,45 +1562,226 @@ class FeedbackModal(ui.Modal, title="Image Feedback"):
                 await finalize_qc_process(interaction, self.session)
 
 # --- Helper Functions ---
-async def update_qc_message(interaction, session):
-    # Create a temporary file to send the current image
-    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
-        current_image = session.processed_images[session.current_index]
-        current_image.save(temp_file, format="PNG")
-    
-    # Build status message
+def build_qc_embed(session, attachment="preview.png"):
+    """Build the QC review embed for the session's current image"""
     status_markers = []
     for i, status in enumerate(session.qc_status):
         if i == session.current_index:
             marker = "🔍"  # Current image
+        elif status is True and i in session.auto_passed:
+            marker = "🤖"  # Passed by auto-QC
         elif status is True:
             marker = "✅"  # Passed
         elif status is False:
             marker = "❌"  # Not passed
+        elif not session.is_ready(i):
+            marker = "⏳"  # Still processing
         else:
             marker = "⬜"  # Pending
         status_markers.append(marker)
     
     status_line = " ".join(status_markers)
-    file = File(temp_file.name, filename="preview.png")
-    
+    description = f"Image {session.current_index + 1} of {len(session.processed_images)}\n{status_line}"
+
+    # Flag near-duplicates and processing problems found during ingest
+    duplicate_note = session.duplicate_notes.get(session.current_index)
+    if duplicate_note:
+        description += f"\n⚠️ {duplicate_note}"
+    processing_error = session.processing_errors.get(session.current_index)
+    if processing_error:
+        description += f"\n⚠️ {processing_error}"
+    score = session.auto_qc.get(session.current_index)
+    if score is not None:
+        verdict = "auto-passed" if session.current_index in session.auto_passed else "needs review"
+        description += f"\n🤖 Auto-QC {verdict} ({describe_auto_qc(score)})"
+
     embed = discord.Embed(
         title=f"QC Review - Supply ID: {session.supply_id}",
-        description=f"Image {session.current_index + 1} of {len(session.processed_images)}\n{status_line}",
+        description=description,
         color=0x3498db
     )
+
+    embed.set_image(url=f"attachment://{attachment}")
+
+    if session.skipped_duplicates:
+        embed.set_footer(text="Skipped near-duplicates: " + ", ".join(session.skipped_duplicates))
+
+    return embed
+
+# --- Contact Sheet ---
+CONTACT_SHEET_CELL = 240
+CONTACT_SHEET_COLUMNS = 6
+CONTACT_SHEET_FRAME = 6
+CONTACT_SHEET_BACKGROUND = 24
+CONTACT_SHEET_COLORS = {
+    "current": (241, 196, 15),
+    "passed": (46, 204, 113),
+    "auto_passed": (52, 152, 219),
+    "failed": (231, 76, 60),
+    "pending": (90, 90, 90),
+    "processing": (45, 45, 45),
+}
+CONTACT_SHEET_LABELS = {"passed": "PASS", "auto_passed": "AUTO", "failed": "FAIL"}
+
+def make_thumbnail(image, cell):
+    """Image scaled to fit a cell x cell square, centred on the sheet background"""
+    thumb = np.asarray(make_proxy(image, cell))
+    height, width = thumb.shape[:2]
+    canvas = np.full((cell, cell, 3), CONTACT_SHEET_BACKGROUND, dtype=np.uint8)
+    top, left = (cell - height) // 2, (cell - width) // 2
+    canvas[top:top + height, left:left + width] = thumb
+    return canvas
+
+def contact_sheet_state(session, index):
+    status = session.qc_status[index]
+    if index == session.current_index:
+        return "current"
+    if status is True:
+        return "auto_passed" if index in session.auto_passed else "passed"
+    if status is False:
+        return "failed"
+    return "pending" if session.is_ready(index) else "processing"
+
+@timed_stage("contact_sheet", size=lambda args, result: len(result))
+def render_contact_sheet(session):
+    """Numbered grid of every processed image, framed by QC status, as one JPEG"""
+    thumbnails = session.thumbnail_stack()
+    count = len(thumbnails)
+    cell, frame = CONTACT_SHEET_CELL, CONTACT_SHEET_FRAME
+    columns = max(1, min(CONTACT_SHEET_COLUMNS, count))
+    rows = math.ceil(count / columns)
+
+    # Frame every cell at once, then lay the (rows * columns) stack out as one image
+    cells = np.full((rows * columns, cell, cell, 3), CONTACT_SHEET_BACKGROUND, dtype=np.uint8)
+    cells[:count] = thumbnails
+    states = [contact_sheet_state(session, i) for i in range(count)]
+    colors = np.full((rows * columns, 3), CONTACT_SHEET_BACKGROUND, dtype=np.uint8)
+    colors[:count] = [CONTACT_SHEET_COLORS[state] for state in states]
+    for region in (np.s_[:, :frame], np.s_[:, -frame:], np.s_[:, :, :frame], np.s_[:, :, -frame:]):
+        cells[region] = colors[:, None, None]
+    sheet = cells.reshape(rows, columns, cell, cell, 3).transpose(0, 2, 1, 3, 4).reshape(rows * cell, columns * cell, 3)
+
+    # Numbers, plus the verdict in words for reviewers who can't tell the frames apart
+    for index, state in enumerate(states):
+        label = f"{index + 1} {CONTACT_SHEET_LABELS.get(state, '')}".strip()
+        origin = ((index % columns) * cell + frame + 6, (index // columns) * cell + frame + 30)
+        cv2.putText(sheet, label, origin, cv2.FONT_HERSHEY_SIMPLEX, 0.9, (0, 0, 0), 5, cv2.LINE_AA)
+        cv2.putText(sheet, label, origin, cv2.FONT_HERSHEY_SIMPLEX, 0.9, (255, 255, 255), 2, cv2.LINE_AA)
+
+    ok, jpeg = cv2.imencode(".jpg", cv2.cvtColor(sheet, cv2.COLOR_RGB2BGR), [cv2.IMWRITE_JPEG_QUALITY, 80])
+    if not ok:
+        raise RuntimeError("Could not encode the contact sheet")
+    return jpeg.tobytes()
+
+@timed_stage("png_encode", size=lambda args, result: os.path.getsize(result))
+def write_preview_file(image):
+    """Encode an image to a temporary PNG file and return its path"""
+    with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
+        image.save(temp_file, format="PNG")
+    return temp_file.name
+
+@timed_stage("png_encode", size=lambda args, result: len(result))
+def encode_png(image):
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='PNG')
+    return img_byte_arr.getvalue()
+
+def upload_approved_image(img, img_no_watermark, filename, watermark_folder_id, no_watermark_folder_id):
+    """Encode and upload both versions of an approved image, returning the watermarked file's (id, link)"""
+    # Upload watermarked version
+    file_id, file_link = upload_to_google_drive(
+        encode_png(img), 
+        filename=filename, 
+        folder_id=watermark_folder_id
+    )
     
-    embed.set_image(url="attachment://preview.png")
-    
+    # Upload non-watermarked version
+    upload_to_google_drive(
+        encode_png(img_no_watermark), 
+        filename=filename, 
+        folder_id=no_watermark_folder_id
+    )
+    return file_id, file_link
+
+def local_output_dirs(supply_id, root=""):
+    """Create the local fallback layout for a supply and return (folder, watermarked_dir, no_watermark_dir)"""
+    local_dir = os.path.join(root, f"approved_images_{supply_id}")
+    watermarked_dir = os.path.join(local_dir, "watermarked")
+    no_watermark_dir = os.path.join(local_dir, "no_watermark")
+    os.makedirs(watermarked_dir, exist_ok=True)
+    os.makedirs(no_watermark_dir, exist_ok=True)
+    return local_dir, watermarked_dir, no_watermark_dir
+
+def save_approved_image_locally(img, img_no_watermark, filename, watermarked_dir, no_watermark_dir):
     try:
-        await interaction.response.edit_message(embed=embed, attachments=[file], view=QCButtons(session))
-    except discord.errors.InteractionResponded:
-        await interaction.message.edit(embed=embed, attachments=[file], view=QCButtons(session))
+        # Save watermarked version
+        filepath_wm = os.path.join(watermarked_dir, filename)
+        img.save(filepath_wm, format='PNG')
+        
+        # Save non-watermarked version
+        filepath_no_wm = os.path.join(no_watermark_dir, filename)
+        img_no_watermark.save(filepath_no_wm, format='PNG')
+        return True
+    except Exception as e:
+        print(f"Error saving image {filename}: {e}")
+        return False
+
+async def update_qc_message(interaction, session):
+    with tracing.span("preview", index=session.current_index):
+        # Acknowledge the click right away; the preview encode may have to wait for a worker
+        if not interaction.response.is_done():
+            await interaction.response.defer()
+
+        preview_path = None
+        if session.contact_sheet:
+            # One small JPEG of the whole supply; images still processing show as empty cells
+            jpeg = await scheduler.run(PRIORITY_INTERACTIVE, session.user_id, render_contact_sheet, session)
+            file = File(io.BytesIO(jpeg), filename="contact_sheet.jpg")
+            embed = build_qc_embed(session, attachment="contact_sheet.jpg")
+            size = len(jpeg)
+        else:
+            # Images from a progressive ingest may still be processing
+            await session.wait_for_image(session.current_index)
+
+            # Create a temporary file to send the current image
+            current_image = session.processed_images[session.current_index]
+            preview_path = await scheduler.run(PRIORITY_INTERACTIVE, session.user_id, write_preview_file, current_image)
+            file = File(preview_path, filename="preview.png")
+            embed = build_qc_embed(session)
+            size = os.path.getsize(preview_path)
+
+        start = time.perf_counter()
+        try:
+            await interaction.response.edit_message(embed=embed, attachments=[file], view=QCButtons(session))
+        except discord.errors.InteractionResponded:
+            await interaction.message.edit(embed=embed, attachments=[file], view=QCButtons(session))
+        observe_io("discord_upload", start, size)
     
-    # Delete the temporary file after sending
-    os.unlink(temp_file.name)
+        # Delete the temporary file after sending
+        if preview_path is not None:
+            os.unlink(preview_path)
 
 async def finalize_qc_process(interaction, session):
+    await finalize_qc_session(interaction.channel, interaction.message, session)
+
+async def finalize_qc_session(channel, qc_message, session):
+    """Upload the passed images and report the result in channel; qc_message is deleted once all passed"""
+    async with session.finalize_lock:
+        # Auto-QC and a reviewer's click can both finish a session; only the first finalize runs
+        if session.message_id not in active_sessions:
+            return
+        with tracing.span("finalize", images=len(session.qc_status)):
+            await _finalize_qc_process(channel, qc_message, session)
+        session.finalized.set()
+
+    # The session is over once everything passed; this also writes its trace
+    if session.message_id not in active_sessions:
+        session.close()
+
+async def _finalize_qc_process(channel, qc_message, session):
+    # Every image must have finished processing before anything is uploaded
+    await session.wait_until_ingested()
+
     approved_images = []
     passed_count = sum(1 for status in session.qc_status if status is True)
     failed_count = sum(1 for status in session.qc_status if status is False)
@@ -489,84 +1798,62 @@ async def finalize_qc_process(interaction, session):
         if is_gdrive_enabled():
             # Create main folder
             main_folder_name = f"Approved_{session.supply_id}"
-            main_folder_id, main_folder_link = create_drive_folder(main_folder_name, parent_id=UPLOAD_FOLDER_ID)
+            main_folder_id, main_folder_link = await run_with_backpressure(
+                PRIORITY_BACKGROUND, session.user_id, create_drive_folder, main_folder_name, UPLOAD_FOLDER_ID
+            )
             
             if main_folder_id:
                 # Create two subfolders
-                watermark_folder_id, _ = create_drive_folder("Watermarked", parent_id=main_folder_id)
-                no_watermark_folder_id, _ = create_drive_folder("No_Watermark", parent_id=main_folder_id)
-                
-                # Upload all approved images to both folders
-                upload_results = []
+                (watermark_folder_id, _), (no_watermark_folder_id, _) = await asyncio.gather(
+                    run_with_backpressure(PRIORITY_BACKGROUND, session.user_id, create_drive_folder, "Watermarked", main_folder_id),
+                    run_with_backpressure(PRIORITY_BACKGROUND, session.user_id, create_drive_folder, "No_Watermark", main_folder_id)
+                )
                 
-                for img, img_no_watermark, filename in approved_images:
-                    # Upload watermarked version
-                    img_byte_arr = io.BytesIO()
-                    img.save(img_byte_arr, format='PNG')
-                    img_bytes = img_byte_arr.getvalue()
-                    
-                    file_id, file_link = upload_to_google_drive(
-                        img_bytes, 
-                        filename=filename, 
-                        folder_id=watermark_folder_id
-                    )
-                    
-                    # Upload non-watermarked version
-                    img_byte_arr_no_wm = io.BytesIO()
-                    img_no_watermark.save(img_byte_arr_no_wm, format='PNG')
-                    img_bytes_no_wm = img_byte_arr_no_wm.getvalue()
-                    
-                    file_id_no_wm, _ = upload_to_google_drive(
-                        img_bytes_no_wm, 
-                        filename=filename, 
-                        folder_id=no_watermark_folder_id
+                # Upload all approved images to both folders as background jobs
+                results = await asyncio.gather(*[
+                    run_with_backpressure(
+                        PRIORITY_BACKGROUND, session.user_id, upload_approved_image,
+                        img, img_no_watermark, filename, watermark_folder_id, no_watermark_folder_id
                     )
-                    
-                    if file_id:
-                        upload_results.append((filename, file_link))
+                    for img, img_no_watermark, filename in approved_images
+                ])
+                upload_results = [
+                    (filename, file_link)
+                    for (_, _, filename), (file_id, file_link) in zip(approved_images, results)
+                    if file_id
+                ]
                 
                 # Final success message
                 if upload_results:
-                    await interaction.channel.send(
+                    await channel.send(
                         f"✅ QC Complete for Supply ID: {session.supply_id}\n"
                         f"📁 Folder Link: {main_folder_link}\n"
                         f"Both watermarked and non-watermarked versions are available in separate subfolders."
                     )
                 else:
-                    await interaction.channel.send(
+                    await channel.send(
                         f"⚠️ QC Complete for Supply ID: {session.supply_id}, but no images were uploaded successfully."
                     )
             else:
-                await interaction.channel.send(
+                await channel.send(
                     f"❌ QC Complete for Supply ID: {session.supply_id}, but failed to create Google Drive folders."
                 )
         else:
             # Google Drive functionality not available - save locally
             # Create directories to save passed images
-            local_dir = f"approved_images_{session.supply_id}"
-            watermarked_dir = os.path.join(local_dir, "watermarked")
-            no_watermark_dir = os.path.join(local_dir, "no_watermark")
-            
-            os.makedirs(watermarked_dir, exist_ok=True)
-            os.makedirs(no_watermark_dir, exist_ok=True)
+            local_dir, watermarked_dir, no_watermark_dir = local_output_dirs(session.supply_id)
             
             # Save all approved images locally
-            saved_count = 0
-            for img, img_no_watermark, filename in approved_images:
-                try:
-                    # Save watermarked version
-                    filepath_wm = os.path.join(watermarked_dir, filename)
-                    img.save(filepath_wm, format='PNG')
-                    
-                    # Save non-watermarked version
-                    filepath_no_wm = os.path.join(no_watermark_dir, filename)
-                    img_no_watermark.save(filepath_no_wm, format='PNG')
-                    
-                    saved_count += 1
-                except Exception as e:
-                    print(f"Error saving image {filename}: {e}")
+            saved = await asyncio.gather(*[
+                run_with_backpressure(
+                    PRIORITY_BACKGROUND, session.user_id, save_approved_image_locally,
+                    img, img_no_watermark, filename, watermarked_dir, no_watermark_dir
+                )
+                for img, img_no_watermark, filename in approved_images
+            ])
+            saved_count = sum(1 for ok in saved if ok)
             
-            await interaction.channel.send(
+            await channel.send(
                 f"✅ QC Complete for Supply ID: {session.supply_id}\n"
                 f"{passed_count} images passed QC.\n"
                 f"⚠️ Google Drive is not configured, so {saved_count} images were saved locally in folder: {local_dir}\n"
@@ -579,7 +1866,7 @@ async def finalize_qc_process(interaction, session):
         failed_nums = [str(i+1) for i in failed_indices]
         
         if not session.all_passed():
-            await interaction.channel.send(
+            await channel.send(
                 f"⚠️ QC Status for Supply ID: {session.supply_id}\n"
                 f"Results: {passed_count} passed, {failed_count} failed.\n"
                 f"Failed images: {', '.join(failed_nums)}\n"
@@ -592,11 +1879,480 @@ async def finalize_qc_process(interaction, session):
         
         # Clean up the QC message
         try:
-            await interaction.message.delete()
+            await qc_message.delete()
         except Exception as e:
             print(f"Error deleting message: {e}")
             pass
 
+async def refresh_when_ingested(qc_message, session):
+    """Update the QC status line once every image is ready and scored by auto-QC.
+
+    If auto-QC decided the last pending images, no reviewer click will
+    finalize the session, so it is finalized here.
+    """
+    # Auto-QC tasks are added as images finish, so wait until no unfinished ones are left
+    while not all(task.done() for task in session.ingest_tasks):
+        await asyncio.gather(*session.ingest_tasks, return_exceptions=True)
+    session.ingest_span.end(images=len(session.processed_images))
+    if retouch_cache.enabled():
+        retouch_cache.log_stats()
+    if session.message_id not in active_sessions:
+        return
+    try:
+        await qc_message.edit(embed=build_qc_embed(session))
+    except Exception as e:
+        print(f"Error refreshing QC message: {e}")
+
+    if session.completed_by_auto_qc and session.is_complete():
+        await finalize_qc_session(qc_message.channel, qc_message, session)
+
+@timed_stage("decode", size=lambda args, result: len(args[0]))
+def decode_image(image_bytes):
+    """Decode an upload to RGB and compute its perceptual hash"""
+    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
+    return image, perceptual_hash(image)
+
+@timed_stage("process_image")
+def process_image(image_bytes, image, plan=None, stage_cache=None):
+    """Retouch an uploaded image and return (retouched, watermarked)"""
+    retouched = cached_retouch(image_bytes, image, plan=plan, stage_cache=stage_cache)
+    return retouched, watermark_with(plan, retouched)
+
+async def start_qc_session(session, status_message, ingested, send_qc, notify=None):
+    """Turn decoded images into a QC session and post its review message.
+
+    ingested holds (filename, image_bytes, image, phash, prepared) tuples, where
+    prepared is an already computed (retouched, watermarked) pair or None.
+    send_qc(content=..., embed=..., file=..., view=...) posts the QC message.
+    """
+    user_id = session.user_id
+    supply_id = session.supply_id
+
+    # Group near-duplicates within the upload (bursts, re-exports)
+    duplicate_of = group_near_duplicates([phash for _, _, _, phash, _ in ingested])
+    session_index_of = {}
+    to_process = []
+    for i, (filename, image_bytes, image, phash, prepared) in enumerate(ingested):
+        dup = duplicate_of[i]
+        if dup is not None and SKIP_NEAR_DUPLICATES:
+            session.skipped_duplicates.append(f"{filename} ≈ {ingested[dup][0]}")
+            continue
+        session_index_of[i] = len(to_process)
+        to_process.append((filename, image_bytes, image, prepared))
+
+        # Flag near-duplicates within this upload and across recent supplies
+        notes = []
+        if dup is not None and dup in session_index_of:
+            notes.append(f"Near-duplicate of image {session_index_of[dup] + 1}")
+        # A re-posted supply (after Cancel or a failed post) is not a duplicate of itself
+        previous = phash_index.find(phash, exclude=supply_id)
+        if previous is not None:
+            notes.append(f"Near-duplicate of an image in Supply ID {previous[0]}")
+        if notes:
+            session.duplicate_notes[session_index_of[i]] = "; ".join(notes)
+
+    # If no images could be decoded
+    if not to_process:
+        await status_message.edit(content="❌ Failed to process any of the attached images.")
+        return None
+
+    phash_index.add(supply_id, [ingested[i][3] for i in session_index_of])
+
+    # Reserve a slot per image; slots fill in as the workers finish
+    count = len(to_process)
+    session.original_images.extend(image for _, _, image, _ in to_process)
+    session.processed_images.extend([None] * count)
+    session.processed_images_no_watermark.extend([None] * count)
+    session.qc_status.extend([None] * count)
+    session.image_ready = [asyncio.Event() for _ in range(count)]
+
+    def fill_slot(index, filename, image, result):
+        if isinstance(result, Exception):
+            # Keep the slot reviewable: show the original so it can be retouched again
+            print(f"Error processing {filename}: {result}")
+            session.processing_errors[index] = f"Retouch failed ({result}); showing the original image"
+            result = (image, watermark_with(session.plan, image))
+
+        session.processed_images_no_watermark[index], session.processed_images[index] = result
+        session.image_ready[index].set()
+        if AUTO_QC_THRESHOLD > 0 and index not in session.processing_errors:
+            session.ingest_tasks.append(asyncio.create_task(auto_qc_slot(index)))
+
+    async def auto_qc_slot(index):
+        image = session.processed_images_no_watermark[index]
+        try:
+            score = await run_with_backpressure(PRIORITY_BULK, user_id, score_retouch, image)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Auto-QC failed for image {index + 1}: {e}")
+            return
+        session.apply_auto_qc(index, score, image)
+
+    async def process_slot(index, filename, image_bytes, image, prepared):
+        try:
+            if prepared is not None:
+                result = prepared
+            else:
+                job = await submit_with_backpressure(
+                    PRIORITY_BULK, user_id, process_image, image_bytes, image, session.plan,
+                    session.stage_cache_for(index, arrays=False), notify=notify
+                )
+                # Duplicates of earlier uploads come straight from the retouch cache
+                result = await job
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            result = e
+        fill_slot(index, filename, image, result)
+
+    async def process_batch_slots(slots):
+        try:
+            job = await submit_with_backpressure(
+                PRIORITY_BULK, user_id, process_image_batch,
+                [(image_bytes, image) for _, _, image_bytes, image in slots], session.plan, notify=notify
+            )
+            results = await job
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            results = [e] * len(slots)
+        for (index, filename, _, image), result in zip(slots, results):
+            fill_slot(index, filename, image, result)
+
+    # Optionally stack same-size images into batches, split so every worker gets one
+    batched = set()
+    session.ingest_tasks = []
+    if BATCH_RETOUCH:
+        candidates = [
+            (index, filename, image_bytes, image)
+            for index, (filename, image_bytes, image, prepared) in enumerate(to_process)
+            if prepared is None
+            and (TILED_MIN_MEGAPIXELS <= 0 or image.width * image.height < TILED_MIN_MEGAPIXELS * 1_000_000)
+        ]
+        per_worker = math.ceil(len(candidates) / max(SCHEDULER_WORKERS, 1))
+        for indices in pipeline.batch_buckets(
+            [slot[3].size for slot in candidates], BATCH_MAX_MEGAPIXELS * 1_000_000, max_images=max(per_worker, 2)
+        ):
+            if len(indices) < 2:
+                continue
+            slots = [candidates[i] for i in indices]
+            batched.update(slot[0] for slot in slots)
+            session.ingest_tasks.append(asyncio.create_task(process_batch_slots(slots)))
+
+    session.ingest_tasks.extend(
+        asyncio.create_task(process_slot(index, filename, image_bytes, image, prepared))
+        for index, (filename, image_bytes, image, prepared) in enumerate(to_process)
+        if index not in batched
+    )
+
+    # Progressive mode shows the first image as soon as it is ready
+    if PROGRESSIVE_INGEST:
+        await session.image_ready[0].wait()
+    else:
+        await asyncio.gather(*session.ingest_tasks)
+        
+    # Save session
+    active_sessions[status_message.id] = session
+    
+    # Create a temporary file to send the first processed image
+    preview_path = await scheduler.run(
+        PRIORITY_INTERACTIVE, user_id, write_preview_file, session.processed_images[0]
+    )
+    
+    # Create an embed for the QC interface
+    file = File(preview_path, filename="preview.png")
+    
+    embed = build_qc_embed(session)
+    
+    # Replace the status message with the QC interface
+    try:
+        await status_message.delete()
+    except Exception as e:
+        print(f"Error deleting status message: {e}")
+        
+    qc_message = None
+    try:
+        start = time.perf_counter()
+        qc_message = await send_qc(
+            embed=embed, 
+            file=file,
+            view=QCButtons(session)
+        )
+        observe_io("discord_upload", start, os.path.getsize(preview_path))
+        
+        # Update the message ID in the session
+        del active_sessions[status_message.id]
+        session.message_id = qc_message.id
+        active_sessions[qc_message.id] = session
+
+        # Refresh the status line once the remaining images are done
+        asyncio.create_task(refresh_when_ingested(qc_message, session))
+
+        # Optionally precompute every "Retouch Again" variant; the speculative class runs one job
+        # at a time behind all other work, so only the number of waiting jobs needs a bound
+        if SPECULATIVE_RETOUCH == "all":
+            for index in range(len(session.original_images)):
+                session.start_speculative_retouch(index, budgeted=True)
+    except Exception as e:
+        print(f"Error sending QC message: {e}")
+        await send_qc(content=f"❌ Error creating QC interface: {str(e)}")
+    
+    # Delete the temporary file
+    try:
+        os.unlink(preview_path)
+    except Exception as e:
+        print(f"Error deleting temporary file: {e}")
+    return qc_message
+
+# --- Watch Folder Ingest ---
+WATCH_MARKER = ".qc_session"
+
+def scan_watch_folder(root):
+    """Return {supply_id: {path: (size, mtime_ns)}} for image files in root/<supply_id>/"""
+    snapshot = {}
+    try:
+        supply_dirs = [entry for entry in os.scandir(root) if entry.is_dir() and not entry.name.startswith(".")]
+    except FileNotFoundError:
+        return snapshot
+    for supply_dir in supply_dirs:
+        # Folders that already have a QC session are done
+        if os.path.exists(os.path.join(supply_dir.path, WATCH_MARKER)):
+            continue
+        files = {}
+        for entry in os.scandir(supply_dir.path):
+            if entry.is_file() and not entry.name.startswith(".") and entry.name.lower().endswith(WATCH_EXTENSIONS):
+                stat = entry.stat()
+                files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+        if files:
+            snapshot[supply_dir.name] = files
+    return snapshot
+
+def prepare_watched_file(path, plan=None):
+    """Read, decode and retouch a dropped file; returns (image_bytes, image, phash, retouched, watermarked)"""
+    with open(path, "rb") as f:
+        image_bytes = f.read()
+    image, phash = decode_image(image_bytes)
+    retouched, watermarked = process_image(image_bytes, image, plan)
+    return image_bytes, image, phash, retouched, watermarked
+
+class WatchedSupply:
+    def __init__(self, supply_id):
+        self.supply_id = supply_id
+        self.seen = {}  # path -> (size, mtime_ns) at the last poll
+        self.jobs = {}  # path -> scheduler future of prepare_watched_file
+        self.last_change = time.monotonic()
+        # collecting, starting (QC session being posted), posted, or failed
+        self.status = "collecting"
+
+class WatchFolderIngest:
+    """Poll WATCH_FOLDER/<supply_id>/ and open a QC session once a supply folder settles.
+
+    Each file is pre-processed as soon as its size stops changing, so most of
+    the work is done by the time the folder is complete and the QC message is
+    posted. A marker file is written into the folder once its session exists.
+    A folder whose session could not be started is left alone until one of
+    its files changes.
+    """
+
+    def __init__(self, root, channel_id, poll_seconds=WATCH_POLL_SECONDS, settle_seconds=WATCH_SETTLE_SECONDS):
+        self.root = root
+        self.channel_id = channel_id
+        self.poll_seconds = poll_seconds
+        self.settle_seconds = settle_seconds
+        self.supplies = {}
+
+    async def run(self):
+        print(f"📂 Watching {self.root} for new supplies")
+        while True:
+            try:
+                await self.poll()
+            except Exception as e:
+                print(f"Error polling watch folder: {e}")
+            await asyncio.sleep(self.poll_seconds)
+
+    async def poll(self):
+        snapshot = await asyncio.to_thread(scan_watch_folder, self.root)
+        now = time.monotonic()
+        for supply_id, files in snapshot.items():
+            state = self.supplies.get(supply_id)
+            if state is not None and state.status in ("starting", "posted"):
+                continue
+            if state is not None and state.status == "failed":
+                if files == state.seen:
+                    continue
+                # Files were added, replaced or removed since the failed attempt: collect them again
+                state = None
+            if state is None:
+                state = self.supplies[supply_id] = WatchedSupply(supply_id)
+
+            for path in set(state.jobs) - set(files):
+                state.jobs.pop(path).cancel()
+            for path, signature in files.items():
+                previous = state.seen.get(path)
+                state.seen[path] = signature
+                if previous != signature:
+                    # New or still being copied: wait for the size to hold steady for a poll
+                    state.last_change = now
+                    job = state.jobs.pop(path, None)
+                    if job is not None:
+                        # Processed from bytes that were still changing; redo it once the file is stable
+                        job.cancel()
+                elif path not in state.jobs:
+                    state.jobs[path] = await submit_with_backpressure(
+                        PRIORITY_BULK, f"watch:{supply_id}", prepare_watched_file, path, plan_for_channel(self.channel_id)
+                    )
+            state.seen = {path: state.seen[path] for path in files}
+
+            if len(state.jobs) == len(files) and now - state.last_change >= self.settle_seconds:
+                state.status = "starting"
+                asyncio.create_task(self.start_session(state))
+
+        # Forget folders that disappeared (or got their marker); a session being started keeps its jobs
+        for supply_id in set(self.supplies) - set(snapshot):
+            if self.supplies[supply_id].status == "starting":
+                continue
+            for job in self.supplies.pop(supply_id).jobs.values():
+                job.cancel()
+
+    async def start_session(self, state):
+        try:
+            posted = await self._start_session(state)
+        except Exception as e:
+            print(f"Error processing watch folder supply {state.supply_id}: {e}")
+            posted = False
+        state.status = "posted" if posted else "failed"
+        if not posted:
+            print(f"Supply ID {state.supply_id} from the watch folder was not posted; waiting for its files to change")
+
+    async def _start_session(self, state):
+        """Post the QC session of a settled supply folder; returns whether it was posted"""
+        channel = bot.get_channel(self.channel_id)
+        if channel is None:
+            print(f"Watch folder channel {self.channel_id} is not available; Supply ID {state.supply_id} not posted")
+            return False
+
+        status_message = await channel.send(
+            f"⏳ Processing {len(state.jobs)} images for Supply ID: {state.supply_id} from the watch folder..."
+        )
+        session = ImageQCSession(
+            message_id=status_message.id,
+            supply_id=state.supply_id,
+            original_images=[],
+            user_id=f"watch:{state.supply_id}"
+        )
+        session.plan = plan_for_channel(self.channel_id)
+        tracing.current_trace.set(session.trace)
+        session.ingest_span = session.trace.start_span("ingest", attachments=len(state.jobs), source="watch_folder")
+
+        try:
+            ingested = []
+            for path in sorted(state.jobs):
+                try:
+                    image_bytes, image, phash, retouched, watermarked = await state.jobs[path]
+                    ingested.append((os.path.basename(path), image_bytes, image, phash, (retouched, watermarked)))
+                except Exception as e:
+                    print(f"Error processing watched file {path}: {e}")
+
+            qc_message = await start_qc_session(session, status_message, ingested, channel.send)
+        except Exception as e:
+            await status_message.edit(content=f"❌ Error processing images: {str(e)}")
+            print(f"Error processing watch folder supply {state.supply_id}: {e}")
+            return False
+        if qc_message is None:
+            return False
+
+        try:
+            with open(os.path.join(self.root, state.supply_id, WATCH_MARKER), "w", encoding="utf-8") as f:
+                f.write(f"{qc_message.id}\n")
+        except OSError as e:
+            # The session exists either way; without the marker it would be posted again after a restart
+            print(f"Error writing watch folder marker for Supply ID {state.supply_id}: {e}")
+        return True
+
+_watch_folder_task = None
+
+def start_watch_folder():
+    """Start polling WATCH_FOLDER once (on_ready fires again after reconnects)"""
+    global _watch_folder_task
+    if not WATCH_FOLDER or _watch_folder_task is not None:
+        return
+    if WATCH_CHANNEL_ID == 0:
+        print("WARNING: WATCH_FOLDER is set but neither WATCH_CHANNEL_ID nor CHANNEL_ID is; watch folder disabled.")
+        return
+    _watch_folder_task = asyncio.create_task(WatchFolderIngest(WATCH_FOLDER, WATCH_CHANNEL_ID).run())
+
+@timed_stage("process_batch")
+def process_image_batch(items, plan=None):
+    """Retouch several same-size uploads as one stacked batch.
+
+    items holds (image_bytes, image) pairs; returns a (retouched, watermarked)
+    pair per item. Cached results are reused and only the misses are batched.
+    """
+    plan = plan or DEFAULT_PLAN
+    retouched = [None] * len(items)
+    keys = [None] * len(items)
+    if retouch_cache.enabled():
+        for i, (image_bytes, _) in enumerate(items):
+            keys[i] = retouch_cache.make_key(image_bytes, {"pipeline": plan.signature})
+            retouched[i] = retouch_cache.get(keys[i])
+
+    misses = [i for i, result in enumerate(retouched) if result is None]
+    if misses:
+        results = split_plan(plan)[0].run_batch(
+            [items[i][1] for i in misses], timer=stage_timer, max_batch_pixels=BATCH_MAX_MEGAPIXELS * 1_000_000
+        )
+        for i, result in zip(misses, results):
+            retouched[i] = result
+            if keys[i] is not None:
+                try:
+                    retouch_cache.put(keys[i], result)
+                except Exception as e:
+                    print(f"Error writing retouch cache entry: {e}")
+    return [(image, watermark_with(plan, image)) for image in retouched]
+
+_metrics_server = None
+
+def start_metrics_server():
+    """Start the local metrics endpoint once (on_ready fires again after reconnects)"""
+    global _metrics_server
+    if METRICS_PORT <= 0 or _metrics_server is not None:
+        return
+    try:
+        _metrics_server = metrics.start_http_server(METRICS_PORT, host=METRICS_HOST)
+        print(f"📈 Metrics available at http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    except OSError as e:
+        print(f"WARNING: Could not start metrics endpoint on port {METRICS_PORT}: {e}")
+
+def describe_blocked_frame(frame):
+    """Name the QC session (or supply) a blocked event-loop stack was working on"""
+    def session_of(frame):
+        local_vars = frame.f_locals
+        session = local_vars.get("session")
+        if not isinstance(session, ImageQCSession):
+            session = getattr(local_vars.get("self"), "session", None)
+        if isinstance(session, ImageQCSession):
+            return f"session {session.message_id}, Supply ID {session.supply_id}"
+        if "supply_id" in local_vars:
+            return f"Supply ID {local_vars['supply_id']}"
+        return None
+    return loop_watchdog.find_in_frames(frame, session_of)
+
+_loop_watchdog = None
+
+def start_loop_watchdog():
+    """Start the event-loop watchdog once on the running loop"""
+    global _loop_watchdog
+    if LOOP_WATCHDOG_MS <= 0 or _loop_watchdog is not None:
+        return
+    _loop_watchdog = loop_watchdog.LoopWatchdog(
+        LOOP_WATCHDOG_MS / 1000,
+        on_lag=lambda lag: LOOP_LAG_SECONDS.observe(lag),
+        on_stall=lambda blocked, context: LOOP_STALLS.inc(),
+        context=describe_blocked_frame,
+    ).start()
+    print(f"🐶 Event-loop watchdog reporting callbacks that block for more than {LOOP_WATCHDOG_MS}ms")
+
 # --- Bot Setup ---
 intents = discord.Intents.default()
 intents.message_content = True
@@ -606,8 +2362,23 @@ bot = commands.Bot(command_prefix='!', intents=intents)
 @bot.event
 async def on_ready():
     print(f'✅ Bot is ready: {bot.user}')
+    start_metrics_server()
+    start_loop_watchdog()
+    start_watch_folder()
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.watching, name="for images to process"))
 
+@bot.command(name="queue")
+async def queue_command(ctx):
+    """Show job scheduler queue depth and wait times"""
+    lines = ["📊 Job queue"]
+    for name, stats in scheduler.metrics().items():
+        lines.append(
+            f"{name}: {stats['depth']} waiting, {stats['running']} running, "
+            f"avg wait {stats['wait_avg']:.2f}s, max wait {stats['wait_max']:.2f}s, "
+            f"{stats['rejected']} rejected"
+        )
+    await ctx.send("\n".join(lines))
+
 @bot.event
 async def on_message(message):
     # Ignore messages from the bot itself
@@ -643,82 +2414,45 @@ async def on_message(message):
             original_images=[],
             user_id=message.author.id
         )
+        session.plan = plan_for_channel(message.channel.id)
+
+        # Everything done for this message (including worker jobs) is traced on the session
+        tracing.current_trace.set(session.trace)
+        session.ingest_span = session.trace.start_span("ingest", attachments=len(image_attachments))
         
         try:
-            # Process each image
+            user_id = message.author.id
+
+            async def notify_backpressure(text):
+                try:
+                    await status_message.edit(content=text)
+                except Exception as e:
+                    print(f"Error posting backpressure notice: {e}")
+
+            # Ingest: download every attachment, then decode and fingerprint them on the workers
+            downloads = []
             for attachment in image_attachments:
                 try:
-                    # Download the image
+                    start = time.perf_counter()
                     image_bytes = await attachment.read()
-                    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-                    
-                    # Store original image
-                    session.original_images.append(image)
-                    
-                    # Process the image
-                    retouched_image = retouch_image(image)
-                    
-                    # Store processed image without watermark
-                    session.processed_images_no_watermark.append(retouched_image)
-                    
-                    # Add watermark and store
-                    watermarked_image = add_watermark(retouched_image)
-                    session.processed_images.append(watermarked_image)
-                    
-                    # Initialize QC status as None (pending)
-                    session.qc_status.append(None)
+                    observe_io("discord_download", start, len(image_bytes))
+                    downloads.append((attachment, image_bytes))
                 except Exception as e:
-                    print(f"Error processing attachment {attachment.filename}: {e}")
-            
-            # If no images were processed successfully
-            if not session.processed_images:
-                await status_message.edit(content="❌ Failed to process any of the attached images.")
-                return
-                
-            # Save session
-            active_sessions[status_message.id] = session
-            
-            # Create a temporary file to send the first processed image
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
-                session.processed_images[0].save(temp_file, format="PNG")
-            
-            # Create an embed for the QC interface
-            file = File(temp_file.name, filename="preview.png")
-            
-            embed = discord.Embed(
-                title=f"QC Review - Supply ID: {supply_id}",
-                description=f"Image 1 of {len(session.processed_images)}\n" + 
-                            "🔍 " + "⬜ " * (len(session.processed_images) - 1),
-                color=0x3498db
-            )
-            
-            embed.set_image(url="attachment://preview.png")
-            
-            # Replace the status message with the QC interface
-            try:
-                await status_message.delete()
-            except Exception as e:
-                print(f"Error deleting status message: {e}")
-                
-            try:
-                qc_message = await message.reply(
-                    embed=embed, 
-                    file=file,
-                    view=QCButtons(session)
-                )
-                
-                # Update the message ID in the session
-                session.message_id = qc_message.id
-                active_sessions[qc_message.id] = session
-            except Exception as e:
-                print(f"Error sending QC message: {e}")
-                await message.reply(f"❌ Error creating QC interface: {str(e)}")
-            
-            # Delete the temporary file
-            try:
-                os.unlink(temp_file.name)
-            except Exception as e:
-                print(f"Error deleting temporary file: {e}")
+                    print(f"Error downloading attachment {attachment.filename}: {e}")
+
+            decode_jobs = [
+                await submit_with_backpressure(PRIORITY_BULK, user_id, decode_image, image_bytes, notify=notify_backpressure)
+                for _, image_bytes in downloads
+            ]
+            ingested = []
+            for (attachment, image_bytes), job in zip(downloads, decode_jobs):
+                try:
+                    image, phash = await job
+                    ingested.append((attachment.filename, image_bytes, image, phash, None))
+                except Exception as e:
+                    print(f"Error decoding attachment {attachment.filename}: {e}")
+
+            await start_qc_session(session, status_message, ingested, message.reply, notify=notify_backpressure)
             
         except Exception as e:
             await status_message.edit(content=f"❌ Error processing images: {str(e)}")
@@ -0,0 +1,90 @@
+"""Print a span waterfall of the slowest QC sessions from the session trace log.
+
+Usage:
+    python trace_report.py                       # reads session_traces.jsonl
+    python trace_report.py traces.jsonl --top 5 --supply 12345
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+
+DEFAULT_TRACE_LOG = os.getenv("TRACE_LOG_PATH", "session_traces.jsonl")
+
+
+def load_traces(path):
+    traces = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                traces.append(json.loads(line))
+            except json.JSONDecodeError as e:
+                print(f"Skipping malformed line {line_number}: {e}", file=sys.stderr)
+    return traces
+
+
+def format_bytes(nbytes):
+    for unit in ("B", "KB", "MB", "GB"):
+        if nbytes < 1024 or unit == "GB":
+            return f"{nbytes:.0f}{unit}" if unit == "B" else f"{nbytes:.1f}{unit}"
+        nbytes /= 1024
+
+
+def print_waterfall(trace, width, min_duration):
+    total = max(trace["duration"], max((s["start"] + s["duration"] for s in trace["spans"]), default=0), 1e-6)
+    print(
+        f"\nSupply ID {trace['supply_id']}  session {trace['session_id']}  "
+        f"user {trace['user_id']}  total {total:.2f}s  spans {len(trace['spans'])}"
+    )
+
+    spans = [span for span in trace["spans"] if span["duration"] >= min_duration]
+    name_width = max((len(span["name"]) for span in spans), default=4)
+    for span in spans:
+        begin = int(span["start"] / total * width)
+        length = max(1, int(span["duration"] / total * width))
+        bar = " " * begin + "█" * min(length, width - begin)
+        details = f"{span['duration'] * 1000:8.1f}ms"
+        if "bytes" in span:
+            details += f" {format_bytes(span['bytes']):>8}"
+        print(f"  {span['name']:<{name_width}} |{bar:<{width}}| {details}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", nargs="?", default=DEFAULT_TRACE_LOG, help="session trace log (JSON lines)")
+    parser.add_argument("--top", type=int, default=10, help="number of slowest sessions to show")
+    parser.add_argument("--supply", help="only show sessions for this supply ID")
+    parser.add_argument("--min-ms", type=float, default=0.0, help="hide spans shorter than this")
+    parser.add_argument("--width", type=int, default=None, help="waterfall width in characters")
+    args = parser.parse_args()
+
+    try:
+        traces = load_traces(args.path)
+    except FileNotFoundError:
+        print(f"No trace log found at {args.path}", file=sys.stderr)
+        return 1
+
+    if args.supply:
+        traces = [trace for trace in traces if str(trace.get("supply_id")) == args.supply]
+    if not traces:
+        print("No sessions to report.")
+        return 0
+
+    width = args.width or max(20, shutil.get_terminal_size((120, 20)).columns - 60)
+    slowest = sorted(traces, key=lambda trace: trace["duration"], reverse=True)[:args.top]
+    durations = sorted(trace["duration"] for trace in traces)
+    p50 = durations[len(durations) // 2]
+    p95 = durations[min(len(durations) - 1, int(len(durations) * 0.95))]
+    print(f"{len(traces)} sessions, p50 {p50:.2f}s, p95 {p95:.2f}s, showing the {len(slowest)} slowest")
+
+    for trace in slowest:
+        print_waterfall(trace, width, args.min_ms / 1000)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+"""Per-session span traces, written as JSON lines when a QC session ends"""
+import contextvars
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Trace of the session whose work is currently running (propagated into worker threads)
+current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Span:
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = dict(attrs)
+        self.start = time.perf_counter()
+
+    def end(self, **attrs):
+        self.attrs.update(attrs)
+        self.trace.add_span(self.name, self.start, time.perf_counter() - self.start, **self.attrs)
+
+
+class SessionTrace:
+    def __init__(self, supply_id, user_id):
+        self.supply_id = supply_id
+        self.user_id = user_id
+        self.session_id = None
+        self.started_at = time.time()
+        self.origin = time.perf_counter()
+        self.spans = []
+        self.lock = threading.Lock()
+        self.written = False
+
+    def add_span(self, name, start, duration, **attrs):
+        """Record a finished span; start is a time.perf_counter() value"""
+        record = {
+            "name": name,
+            "start": round(start - self.origin, 6),
+            "duration": round(duration, 6),
+            "thread": threading.current_thread().name,
+        }
+        record.update({key: value for key, value in attrs.items() if value is not None})
+        with self.lock:
+            self.spans.append(record)
+
+    def start_span(self, name, **attrs):
+        """Open a span that is ended explicitly, possibly from another task"""
+        return Span(self, name, attrs)
+
+    @contextmanager
+    def span(self, name, **attrs):
+        span = self.start_span(name, **attrs)
+        try:
+            yield span.attrs
+        finally:
+            span.end()
+
+    def to_record(self):
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["start"])
+        return {
+            "session_id": self.session_id,
+            "supply_id": self.supply_id,
+            "user_id": self.user_id,
+            "started_at": self.started_at,
+            "duration": round(time.perf_counter() - self.origin, 6),
+            "spans": spans,
+        }
+
+    def write(self, path):
+        """Append the trace as one JSON line (only the first call writes)"""
+        with self.lock:
+            if self.written:
+                return
+            self.written = True
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.to_record(), default=str) + "\n")
+
+
+def record_span(name, start, duration, **attrs):
+    """Add a span to the current session trace, if there is one"""
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(name, start, duration, **attrs)
+
+
+@contextmanager
+def span(name, **attrs):
+    """Time a block as a span of the current session trace (no-op outside a session)"""
+    trace = current_trace.get()
+    if trace is None:
+        yield {}
+        return
+    with trace.span(name, **attrs) as span_attrs:
+        yield span_attrs